@@ -1,16 +1,38 @@
 #!/usr/bin/env python3
 
 import datetime
+import functools
+import gzip
 import hashlib
 import json
 import logging
+import os
+import signal
+import time
 import uuid
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from optparse import OptionParser
-from typing import Any, Dict, Tuple
-
-from scoring import get_interests, get_score
-from storage import Storage
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import msgpack
+except ImportError:  # optional dependency, install the `msgpack` extra
+    msgpack = None
+try:
+    import zstandard
+except ImportError:  # optional dependency, install the `zstd` extra
+    zstandard = None
+
+import bloom
+import memwatch
+import scoring
+import shmcache
+from interests_store import MmapInterestsStore
+from ratelimit import Lane, LoadShedder, LocalRateLimiter, RedisRateLimiter
+from response_cache import CachedResponse, ResponseCache
+from scoring import get_interests, get_interests_as_of, get_score
+from storage import DeadlineExceeded, Storage, remaining
 
 SALT = "Otus"
 ADMIN_LOGIN = "admin"
@@ -19,15 +41,28 @@ OK = 200
 BAD_REQUEST = 400
 FORBIDDEN = 403
 NOT_FOUND = 404
+UNSUPPORTED_MEDIA_TYPE = 415
 INVALID_REQUEST = 422
+TOO_MANY_REQUESTS = 429
 INTERNAL_ERROR = 500
+SERVICE_UNAVAILABLE = 503
+GATEWAY_TIMEOUT = 504
 ERRORS = {
     BAD_REQUEST: "Bad Request",
     FORBIDDEN: "Forbidden",
     NOT_FOUND: "Not Found",
+    UNSUPPORTED_MEDIA_TYPE: "Unsupported Media Type",
     INVALID_REQUEST: "Invalid Request",
+    TOO_MANY_REQUESTS: "Too Many Requests",
     INTERNAL_ERROR: "Internal Server Error",
+    SERVICE_UNAVAILABLE: "Service Unavailable",
+    GATEWAY_TIMEOUT: "Gateway Timeout",
 }
+# seconds a request may take when the client sends no X-Request-Timeout
+DEFAULT_REQUEST_TIMEOUT = 10
+# clients_interests requests for more ids run in this lane when it is set up
+HEAVY_LANE = "heavy"
+DEFAULT_HEAVY_LANE_IDS = 100
 BIRTHDAY_DIFF = 70
 UNKNOWN = 0
 MALE = 1
@@ -38,6 +73,31 @@ GENDERS = {
     FEMALE: "female",
 }
 NULL_VALUES = [None, "", [], {}, ()]
+JSON_TYPE = "application/json"
+MSGPACK_TYPE = "application/msgpack"
+MSGPACK_ALIASES = [MSGPACK_TYPE, "application/x-msgpack"]
+
+
+# content encoding -> compressor(data, level), most preferred first
+COMPRESSORS = {}
+if zstandard is not None:
+    COMPRESSORS["zstd"] = lambda data, level: zstandard.ZstdCompressor(
+        level=level
+    ).compress(data)
+COMPRESSORS["gzip"] = lambda data, level: gzip.compress(data, compresslevel=level)
+
+
+def json_dumps(data: Any) -> bytes:
+    return json.dumps(data).encode("utf-8")
+
+
+# content type -> (decoder, encoder)
+CODECS = {JSON_TYPE: (json.loads, json_dumps)}
+if msgpack is not None:
+    CODECS[MSGPACK_TYPE] = (
+        functools.partial(msgpack.unpackb, strict_map_key=False),
+        msgpack.packb,
+    )
 
 
 class CustomValidationError(Exception):
@@ -247,10 +307,26 @@ class OnlineScoreRequest(BaseRequest):
         )
 
 
+@contextmanager
+def timed(ctx: Dict[str, Any], stage: str) -> Iterator[None]:
+    """Record monotonic duration (ms) of the wrapped block in ctx timings"""
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        elapsed = round((time.monotonic() - start) * 1000, 3)
+        ctx.setdefault("timings", {})[stage] = elapsed
+
+
+@functools.lru_cache(maxsize=2)
+def get_admin_digest(hour: str) -> str:
+    # the same for every admin request within an hour
+    return hashlib.sha512((hour + ADMIN_SALT).encode("utf-8")).hexdigest()
+
+
 def check_auth(request: MethodRequest) -> bool:
     if request.is_admin:
-        hash_str = datetime.datetime.now().strftime("%Y%m%d%H") + ADMIN_SALT
-        digest = hashlib.sha512(hash_str.encode("utf-8")).hexdigest()
+        digest = get_admin_digest(datetime.datetime.now().strftime("%Y%m%d%H"))
     else:
         hash_str = request.account + request.login + SALT
         digest = hashlib.sha512(hash_str.encode("utf-8")).hexdigest()
@@ -260,7 +336,10 @@ def check_auth(request: MethodRequest) -> bool:
 
 
 def online_score_handler(
-    method_request: MethodRequest, ctx: Dict[str, Any], store
+    method_request: MethodRequest,
+    ctx: Dict[str, Any],
+    store,
+    deadline: Optional[float] = None,
 ) -> Tuple[Any, int, Dict[str, Any]]:
     method_args = method_request.arguments
     ctx["has"] = [k for k, v in method_args.items() if v not in NULL_VALUES]
@@ -279,58 +358,272 @@ def online_score_handler(
         gender=req.gender,
         first_name=req.first_name,
         last_name=req.last_name,
+        deadline=deadline,
     )
     return {"score": score}, OK, ctx
 
 
 def clients_interests_handler(
-    method_request: MethodRequest, ctx: Dict[str, Any], store
+    method_request: MethodRequest,
+    ctx: Dict[str, Any],
+    store,
+    deadline: Optional[float] = None,
 ) -> Tuple[Any, int, Dict[str, Any]]:
     req = ClientsInterestsRequest(method_request.arguments)
     req.validate()
     ctx["nclients"] = len(req.client_ids)
-    response = dict()
-    for client_id in req.client_ids:
-        response[client_id] = get_interests(store, client_id)
+    if req.date and hasattr(store, "get_versions"):
+        date = DateField.parse_date(req.date)
+        response = get_interests_as_of(store, req.client_ids, date, deadline)
+    else:
+        # snapshots only have the latest interests
+        response = dict()
+        for client_id in req.client_ids:
+            response[client_id] = get_interests(store, client_id, deadline)
+    interests_filter = getattr(store, "interests_filter", None)
+    if interests_filter is not None:
+        ctx["filter_fpr"] = round(interests_filter.false_positive_rate, 6)
     return response, OK, ctx
 
 
+def memory_stats_handler(
+    method_request: MethodRequest,
+    ctx: Dict[str, Any],
+    store,
+    deadline: Optional[float] = None,
+) -> Tuple[Any, int, Dict[str, Any]]:
+    if not method_request.is_admin:
+        return None, FORBIDDEN, ctx
+    # tracing slows down every allocation, it is only switched on and off
+    # on request (or from the start with --tracemalloc)
+    tracing = (method_request.arguments or {}).get("tracemalloc")
+    if tracing is not None and not isinstance(tracing, bool):
+        raise CustomValidationError(
+            INVALID_REQUEST, "Expected `bool` type for argument tracemalloc"
+        )
+    if tracing is True:
+        memwatch.watcher.start()
+    elif tracing is False:
+        memwatch.watcher.stop()
+    return memwatch.watcher.report(), OK, ctx
+
+
+def lane_stats_handler(
+    method_request: MethodRequest,
+    ctx: Dict[str, Any],
+    store,
+    deadline: Optional[float] = None,
+    lanes: Optional[Dict[str, Lane]] = None,
+) -> Tuple[Any, int, Dict[str, Any]]:
+    if not method_request.is_admin:
+        return None, FORBIDDEN, ctx
+    return {name: lane.stats() for name, lane in (lanes or {}).items()}, OK, ctx
+
+
+def get_lane(
+    lanes: Optional[Dict[str, Lane]],
+    method_request: MethodRequest,
+    heavy_lane_ids: int = DEFAULT_HEAVY_LANE_IDS,
+) -> Optional[Lane]:
+    """Lane of the method, requests for many client ids go to the heavy one"""
+    if not lanes:
+        return None
+    if method_request.method == "clients_interests":
+        client_ids = (method_request.arguments or {}).get("client_ids")
+        if isinstance(client_ids, list) and len(client_ids) > heavy_lane_ids:
+            return lanes.get(HEAVY_LANE) or lanes.get(method_request.method)
+    return lanes.get(method_request.method)
+
+
 def method_handler(
-    request: Dict[str, Any], ctx: Dict[str, Any], store
+    request: Dict[str, Any],
+    ctx: Dict[str, Any],
+    store,
+    limiter=None,
+    interests_store=None,
+    deadline: Optional[float] = None,
+    lanes: Optional[Dict[str, Lane]] = None,
+    response_cache: Optional[ResponseCache] = None,
+    heavy_lane_ids: int = DEFAULT_HEAVY_LANE_IDS,
 ) -> Tuple[Any, int, Dict[str, Any]]:
     routers = {
         "online_score": online_score_handler,
         "clients_interests": clients_interests_handler,
+        "memory_stats": memory_stats_handler,
+        "lane_stats": functools.partial(lane_stats_handler, lanes=lanes),
     }
+    # methods served from a dedicated backend instead of the main storage
+    stores = {"clients_interests": interests_store}
     try:
         method_request = MethodRequest(request["body"])
-        method_request.validate()
-        if not check_auth(method_request):
+        with timed(ctx, "validate"):
+            method_request.validate()
+        with timed(ctx, "auth"):
+            authorized = check_auth(method_request)
+        if not authorized:
             return None, FORBIDDEN, ctx
+        rate_key = method_request.account or method_request.login
+        if limiter is not None and not limiter.allow(rate_key):
+            return None, TOO_MANY_REQUESTS, ctx
         method = method_request.method
         if method not in routers:
             return f"Not found for {method}", NOT_FOUND, ctx
-        response, code, ctx = routers[method](method_request, ctx, store)
+        if response_cache is not None and method in response_cache.methods:
+            with timed(ctx, "response_cache"):
+                cached = response_cache.lookup(
+                    method,
+                    method_request.arguments,
+                    request.get("variant", ()),
+                    ctx,
+                    deadline,
+                )
+            if cached is not None:
+                return cached, OK, ctx
+        lane = get_lane(lanes, method_request, heavy_lane_ids)
+        if lane is not None:
+            ctx["lane"] = lane.name
+            with timed(ctx, "queue"):
+                waited = lane.acquire(remaining(deadline))
+            if waited is None and remaining(deadline) <= 0:
+                return "Request timeout: waiting for a worker", GATEWAY_TIMEOUT, ctx
+            if waited is None:
+                return None, SERVICE_UNAVAILABLE, ctx
+        try:
+            with timed(ctx, "handler"):
+                response, code, ctx = routers[method](
+                    method_request, ctx, stores.get(method) or store, deadline
+                )
+        finally:
+            if lane is not None:
+                lane.release()
     except CustomValidationError as e:
         return e.error, e.code, ctx
+    except DeadlineExceeded as e:
+        return f"Request timeout: {e}", GATEWAY_TIMEOUT, ctx
     else:
         return response, code, ctx
 
 
 class MainHTTPHandler(BaseHTTPRequestHandler):
     router = {"method": method_handler}
-    store = Storage(socket_timeout=120, socket_connect_timeout=60)
+    store = Storage(
+        socket_timeout=DEFAULT_REQUEST_TIMEOUT,
+        socket_connect_timeout=DEFAULT_REQUEST_TIMEOUT,
+    )
+    request_timeout = DEFAULT_REQUEST_TIMEOUT
+    rate_limiter = None
+    interests_store = None
+    load_shedder = LoadShedder()
+    # lane name -> Lane, requests of methods without a lane are not queued
+    lanes: Dict[str, Lane] = {}
+    # clients_interests for more ids than this go to the heavy lane
+    heavy_lane_ids = DEFAULT_HEAVY_LANE_IDS
+    response_cache: Optional[ResponseCache] = None
+    # responses smaller than this are sent uncompressed, negative disables
+    compress_min_size = 1024
+    compress_level = 6
 
     def get_request_id(self, headers):
-        return headers.get("HTTP_X_REQUEST_ID", uuid.uuid4().hex)
+        return headers.get("X-Request-Id") or uuid.uuid4().hex
+
+    @staticmethod
+    def get_server_timing(context: Dict[str, Any]) -> str:
+        metrics = [
+            f"{stage};dur={duration}"
+            for stage, duration in context.get("timings", {}).items()
+        ]
+        for name, stat in context.get("storage", {}).items():
+            metrics.append(f'storage_{name};dur={stat["ms"]};desc="{stat["count"]}"')
+        return ", ".join(metrics)
+
+    def get_request_timeout(self) -> float:
+        """X-Request-Timeout seconds, a client can shorten the budget only"""
+        try:
+            timeout = float(self.headers.get("X-Request-Timeout", ""))
+        except ValueError:
+            return self.request_timeout
+        if timeout <= 0:
+            return self.request_timeout
+        return min(timeout, self.request_timeout)
+
+    def get_content_type(self) -> str:
+        content_type = self.headers.get("Content-Type", "").split(";")[0].strip()
+        # anything but msgpack is treated as json, as it always was
+        return MSGPACK_TYPE if content_type in MSGPACK_ALIASES else JSON_TYPE
+
+    def get_response_type(self) -> str:
+        for accepted in self.headers.get("Accept", "").split(","):
+            accepted = accepted.split(";")[0].strip()
+            if accepted in MSGPACK_ALIASES and MSGPACK_TYPE in CODECS:
+                return MSGPACK_TYPE
+            if accepted == JSON_TYPE:
+                return JSON_TYPE
+        return JSON_TYPE
+
+    def get_content_encoding(self) -> Optional[str]:
+        accepted = {}
+        for item in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = item.partition(";")
+            quality = 1.0
+            if params.strip().startswith("q="):
+                try:
+                    quality = float(params.strip()[2:])
+                except ValueError:
+                    continue
+            accepted[name.strip().lower()] = quality
+        for encoding in COMPRESSORS:
+            if accepted.get(encoding, 0) > 0:
+                return encoding
+        return None
+
+    def compress(
+        self, data: bytes, context: Dict[str, Any]
+    ) -> Tuple[Optional[str], bytes]:
+        if self.compress_min_size < 0 or len(data) < self.compress_min_size:
+            return None, data
+        encoding = self.get_content_encoding()
+        if encoding is None:
+            return None, data
+        with timed(context, "compress"):
+            compressed = COMPRESSORS[encoding](data, self.compress_level)
+        context["compression"] = {
+            "encoding": encoding,
+            "size": len(data),
+            "compressed_size": len(compressed),
+        }
+        return encoding, compressed
 
     def do_POST(self):
+        context = {"request_id": self.get_request_id(self.headers), "timings": {}}
+        context["timeout"] = self.get_request_timeout()
+        deadline = time.monotonic() + context["timeout"]
+        if not self.load_shedder.acquire():
+            # overloaded: answer right away instead of queueing the request
+            self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            self.send_result(None, SERVICE_UNAVAILABLE, context)
+            return
+        try:
+            response, code, context = self.process_request(context, deadline)
+            self.send_result(response, code, context)
+        finally:
+            self.load_shedder.release()
+
+    def process_request(
+        self, context: Dict[str, Any], deadline: float
+    ) -> Tuple[Any, int, Dict[str, Any]]:
         response, code = {}, OK
-        context = {"request_id": self.get_request_id(self.headers)}
+        self.store.reset_stats()
         request = None
+        content_type = self.get_content_type()
         try:
-            data_string = self.rfile.read(int(self.headers["Content-Length"]))
-            request = json.loads(data_string)
+            with timed(context, "read"):
+                data_string = self.rfile.read(int(self.headers["Content-Length"]))
+            if content_type in CODECS:
+                decode, _ = CODECS[content_type]
+                with timed(context, "decode"):
+                    request = decode(data_string)
+            else:
+                code = UNSUPPORTED_MEDIA_TYPE
         except:
             code = BAD_REQUEST
 
@@ -339,8 +632,18 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             logging.info("%s: %s %s" % (self.path, data_string, context["request_id"]))
             if path in self.router:
                 try:
+                    # a cached response is only good for the same format
+                    variant = (self.get_response_type(), self.get_content_encoding())
                     response, code, context = self.router[path](
-                        {"body": request, "headers": self.headers}, context, self.store
+                        {"body": request, "headers": self.headers, "variant": variant},
+                        context,
+                        self.store,
+                        limiter=self.rate_limiter,
+                        interests_store=self.interests_store,
+                        deadline=deadline,
+                        lanes=self.lanes,
+                        response_cache=self.response_cache,
+                        heavy_lane_ids=self.heavy_lane_ids,
                     )
                 except Exception as e:
                     logging.exception("Unexpected error: %s" % e)
@@ -348,34 +651,264 @@ class MainHTTPHandler(BaseHTTPRequestHandler):
             else:
                 code = NOT_FOUND
 
+        context["storage"] = self.store.get_stats()
+        return response, code, context
+
+    def send_result(self, response: Any, code: int, context: Dict[str, Any]) -> None:
+        response_type = self.get_response_type()
+        if isinstance(response, CachedResponse):
+            # already encoded and compressed when it was cached
+            r = {"code": code}
+            encoding, data = response
+        else:
+            if code not in ERRORS:
+                r = {"response": response, "code": code}
+            else:
+                error = response or ERRORS.get(code, "Unknown Error")
+                r = {"error": error, "code": code}
+            _, encode = CODECS[response_type]
+            with timed(context, "encode"):
+                data = encode(r)
+            encoding, data = self.compress(data, context)
+            cache_entry = context.pop("response_cache_entry", None)
+            if cache_entry is not None and code == OK:
+                self.response_cache.store_response(cache_entry, encoding, data)
         self.send_response(code)
-        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Type", response_type)
+        if encoding is not None:
+            self.send_header("Content-Encoding", encoding)
+        if self.compress_min_size >= 0:
+            self.send_header("Vary", "Accept-Encoding")
+        self.send_header("Server-Timing", self.get_server_timing(context))
+        if code in (TOO_MANY_REQUESTS, SERVICE_UNAVAILABLE):
+            self.send_header("Retry-After", "1")
         self.end_headers()
-        if code not in ERRORS:
-            r = {"response": response, "code": code}
-        else:
-            r = {"error": response or ERRORS.get(code, "Unknown Error"), "code": code}
         context.update(r)
         logging.info(context)
-        self.wfile.write(json.dumps(r).encode("utf-8"))
-        return
+        self.wfile.write(data)
+
+
+def fork_workers(count: int) -> List[int]:
+    """Fork count - 1 more processes accepting on the already bound socket.
+
+    Returns pids of the children in the parent and nothing in a child.
+    """
+    children = []
+    for _ in range(count - 1):
+        pid = os.fork()
+        if pid == 0:
+            return []
+        children.append(pid)
+    return children
 
 
 if __name__ == "__main__":
     op = OptionParser()
     op.add_option("-p", "--port", action="store", type=int, default=8080)
     op.add_option("-l", "--log", action="store", default=None)
+    op.add_option(
+        "--rate-limit",
+        action="store",
+        type=float,
+        default=0,
+        help="requests per second allowed per account, 0 disables limiting",
+    )
+    op.add_option("--rate-burst", action="store", type=int, default=10)
+    op.add_option(
+        "--rate-limit-redis",
+        action="store_true",
+        default=False,
+        help="share rate limit buckets between workers via redis",
+    )
+    op.add_option(
+        "--max-inflight",
+        action="store",
+        type=int,
+        default=0,
+        help="respond 503 when more requests are in flight, 0 disables shedding",
+    )
+    op.add_option(
+        "--interests-file",
+        action="store",
+        default=None,
+        help="serve clients_interests from a snapshot built by interests_store.py",
+    )
+    op.add_option(
+        "--compress-min-size",
+        action="store",
+        type=int,
+        default=MainHTTPHandler.compress_min_size,
+        help="compress responses of at least this many bytes, -1 disables",
+    )
+    op.add_option(
+        "--compress-level",
+        action="store",
+        type=int,
+        default=MainHTTPHandler.compress_level,
+    )
+    op.add_option(
+        "--tracemalloc",
+        action="store_true",
+        default=False,
+        help="trace allocations from the start, see the memory_stats method",
+    )
+    op.add_option(
+        "--memory-log-interval",
+        action="store",
+        type=float,
+        default=0,
+        help="log memory growth every N seconds, 0 disables",
+    )
+    op.add_option(
+        "--score-soft-ttl",
+        action="store",
+        type=int,
+        default=scoring.SCORE_SOFT_TTL,
+        help="seconds a cached score is served without refreshing it",
+    )
+    op.add_option(
+        "--score-hard-ttl",
+        action="store",
+        type=int,
+        default=scoring.SCORE_HARD_TTL,
+        help="seconds a cached score is kept, stale ones are refreshed in background",
+    )
+    op.add_option(
+        "--interests-filter",
+        action="store",
+        default=None,
+        help="bloom filter file of client ids with interests, built if missing "
+        "or older than the interests in redis",
+    )
+    op.add_option(
+        "--request-timeout",
+        action="store",
+        type=float,
+        default=DEFAULT_REQUEST_TIMEOUT,
+        help="seconds a request may take at most, X-Request-Timeout can shorten it",
+    )
+    op.add_option(
+        "--score-key-format",
+        action="store",
+        type="choice",
+        choices=scoring.SCORE_KEY_FORMATS,
+        default=scoring.SCORE_KEY_FORMAT,
+        help="score cache keys as raw binary digests or readable hex",
+    )
+    op.add_option(
+        "--score-lookup",
+        action="store",
+        type="choice",
+        choices=scoring.SCORE_LOOKUP_MODES,
+        default=scoring.SCORE_LOOKUP,
+        help="`script` calculates and caches missed scores in redis in one call",
+    )
+    op.add_option(
+        "--response-cache-ttl",
+        action="store",
+        type=int,
+        default=0,
+        help="seconds clients_interests responses are cached for, 0 disables",
+    )
+    op.add_option(
+        "--workers",
+        action="store",
+        type=int,
+        default=1,
+        help="processes serving the port, forked after it is bound",
+    )
+    op.add_option(
+        "--shared-cache-slots",
+        action="store",
+        type=int,
+        default=0,
+        help="scores cached in memory shared by the workers, 0 disables",
+    )
+    op.add_option(
+        "--lane",
+        action="append",
+        default=[],
+        help="name=workers[:queue] limits requests of a method, repeatable; "
+        f"clients_interests for more than --heavy-lane-ids ids use `{HEAVY_LANE}`",
+    )
+    op.add_option(
+        "--heavy-lane-ids", action="store", type=int, default=DEFAULT_HEAVY_LANE_IDS
+    )
     (opts, args) = op.parse_args()
+    try:
+        lanes = [Lane.parse(spec) for spec in opts.lane]
+    except ValueError as e:
+        op.error(str(e))
     logging.basicConfig(
         filename=opts.log,
         level=logging.INFO,
         format="[%(asctime)s] %(levelname).1s %(message)s",
         datefmt="%Y.%m.%d %H:%M:%S",
     )
-    server = HTTPServer(("localhost", opts.port), MainHTTPHandler)
+    # a single redis call never blocks longer than a whole request may take
+    MainHTTPHandler.request_timeout = opts.request_timeout
+    MainHTTPHandler.store = Storage(
+        socket_timeout=opts.request_timeout,
+        socket_connect_timeout=opts.request_timeout,
+    )
+    if opts.rate_limit and opts.rate_limit_redis:
+        MainHTTPHandler.rate_limiter = RedisRateLimiter(
+            MainHTTPHandler.store.client, opts.rate_limit, opts.rate_burst
+        )
+    elif opts.rate_limit:
+        MainHTTPHandler.rate_limiter = LocalRateLimiter(
+            opts.rate_limit, opts.rate_burst
+        )
+    MainHTTPHandler.load_shedder = LoadShedder(opts.max_inflight)
+    MainHTTPHandler.lanes = {lane.name: lane for lane in lanes}
+    MainHTTPHandler.heavy_lane_ids = opts.heavy_lane_ids
+    if opts.response_cache_ttl:
+        MainHTTPHandler.response_cache = ResponseCache(
+            MainHTTPHandler.store, opts.response_cache_ttl
+        )
+    MainHTTPHandler.compress_min_size = opts.compress_min_size
+    MainHTTPHandler.compress_level = opts.compress_level
+    if opts.interests_filter:
+        interests_filter = bloom.open_filter(
+            MainHTTPHandler.store.client, opts.interests_filter
+        )
+        MainHTTPHandler.store.interests_filter = interests_filter
+        logging.info(
+            "Interests filter false positive rate %.4f"
+            % interests_filter.false_positive_rate
+        )
+    if opts.interests_file:
+        MainHTTPHandler.interests_store = MmapInterestsStore(opts.interests_file)
+    scoring.SCORE_SOFT_TTL = opts.score_soft_ttl
+    scoring.SCORE_HARD_TTL = opts.score_hard_ttl
+    scoring.SCORE_KEY_FORMAT = opts.score_key_format
+    scoring.SCORE_LOOKUP = opts.score_lookup
+    shared_cache = None
+    if opts.shared_cache_slots:
+        # created before forking, so every worker maps the same memory
+        shared_cache = shmcache.SharedCache(opts.shared_cache_slots)
+        MainHTTPHandler.store.local_cache = shared_cache
+    if opts.tracemalloc:
+        memwatch.watcher.start()
+    memwatch.watcher.install_signal_handler()
+    server = ThreadingHTTPServer(("localhost", opts.port), MainHTTPHandler)
     logging.info("Starting server at %s" % opts.port)
+    parent = os.getpid()
+    children = fork_workers(opts.workers)
+    # threads are not inherited by forked workers, start them in each one
+    if opts.memory_log_interval:
+        memwatch.watcher.start_periodic(opts.memory_log_interval)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         pass
     server.server_close()
+    if os.getpid() == parent:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        if shared_cache is not None:
+            shared_cache.unlink()
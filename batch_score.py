@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""Score a jsonl file of online_score arguments outside of the http server.
+
+Every input line gets an output line in the same order, either
+{"score": ...} or {"error": ..., "code": ...} like the api responds.
+"""
+
+import itertools
+import json
+import logging
+import multiprocessing
+import os
+import time
+from collections import deque
+from optparse import OptionParser
+from typing import Callable, Iterable, Iterator, List, Optional, TextIO
+
+import api
+import scoring
+from storage import Storage
+
+# storage of the current worker process
+store: Optional[Storage] = None
+
+
+def default_storage() -> Storage:
+    return Storage(socket_timeout=10, socket_connect_timeout=10)
+
+
+def init_worker(storage_factory: Callable[[], Storage]) -> None:
+    global store
+    store = storage_factory()
+
+
+def parse_line(line: str) -> dict:
+    """Validate a line like online_score_handler does, return score arguments"""
+    try:
+        arguments = json.loads(line)
+    except ValueError:
+        raise api.CustomValidationError(api.BAD_REQUEST, "Unable to parse json")
+    if not isinstance(arguments, dict):
+        raise api.CustomValidationError(
+            api.INVALID_REQUEST, "Expected `dict` with online_score arguments"
+        )
+    req = api.OnlineScoreRequest(arguments)
+    req.validate()
+    return {
+        "phone": req.phone,
+        "email": req.email,
+        "birthday": api.DateField.parse_date(req.birthday) if req.birthday else None,
+        "gender": req.gender,
+        "first_name": req.first_name,
+        "last_name": req.last_name,
+    }
+
+
+def score_chunk(lines: List[str]) -> List[str]:
+    results, people, positions = [None] * len(lines), [], []
+    for pos, line in enumerate(lines):
+        try:
+            people.append(parse_line(line))
+            positions.append(pos)
+        except api.CustomValidationError as e:
+            results[pos] = {"error": e.error, "code": e.code}
+    # the whole chunk shares a single cache read and a single cache write
+    for pos, score in zip(positions, scoring.get_scores(store, people)):
+        results[pos] = {"score": score}
+    return [json.dumps(result) for result in results]
+
+
+def read_chunks(lines: Iterable[str], chunk_size: int) -> Iterator[List[str]]:
+    lines = iter(lines)
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def score_file(
+    source: TextIO,
+    target: TextIO,
+    workers: int = 0,
+    chunk_size: int = 1000,
+    storage_factory: Callable[[], Storage] = default_storage,
+) -> int:
+    """Score source lines into target, return the number of lines"""
+    chunks = read_chunks(source, chunk_size)
+    total, started = 0, time.monotonic()
+
+    def write(results: List[str]) -> None:
+        nonlocal total
+        target.writelines(result + "\n" for result in results)
+        total += len(results)
+        elapsed = max(time.monotonic() - started, 1e-9)
+        logging.info("Scored %s lines, %.0f lines/s" % (total, total / elapsed))
+
+    if workers <= 1:
+        init_worker(storage_factory)
+        for chunk in chunks:
+            write(score_chunk(chunk))
+        return total
+
+    with multiprocessing.Pool(workers, init_worker, (storage_factory,)) as pool:
+        # keep a bounded number of chunks in flight, so memory doesn't grow
+        # with the file size, and write them out in input order
+        pending = deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(score_chunk, (chunk,)))
+            if len(pending) >= workers * 2:
+                write(pending.popleft().get())
+        while pending:
+            write(pending.popleft().get())
+    return total
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog -i people.jsonl -o scores.jsonl")
+    op.add_option("-i", "--input", action="store")
+    op.add_option("-o", "--output", action="store")
+    op.add_option(
+        "-w", "--workers", action="store", type=int, default=os.cpu_count() or 1
+    )
+    op.add_option("-c", "--chunk-size", action="store", type=int, default=1000)
+    (opts, args) = op.parse_args()
+    if not opts.input or not opts.output:
+        op.error("both --input and --output are required")
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname).1s %(message)s",
+        datefmt="%Y.%m.%d %H:%M:%S",
+    )
+    started = time.monotonic()
+    with open(opts.input) as source, open(opts.output, "w") as target:
+        total = score_file(source, target, opts.workers, opts.chunk_size)
+    elapsed = max(time.monotonic() - started, 1e-9)
+    logging.info(
+        "Done: %s lines in %.1fs, %.0f lines/s" % (total, elapsed, total / elapsed)
+    )
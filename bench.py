@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the request hot path.
+
+Timings are divided by a fixed pure python calibration loop measured
+alongside, so that baselines recorded on one machine stay comparable on
+another one. A benchmark fails when it got slower than its baseline by more
+than the threshold.
+"""
+
+import datetime
+import hashlib
+import itertools
+import json
+import sys
+import timeit
+from optparse import OptionParser
+from typing import Any, Callable, Dict, List, Tuple
+
+import fakeredis
+
+import api
+import scoring
+from storage import Storage
+
+BASELINE_FILE = "bench_baseline.json"
+ACCOUNT = "horns&hoofs"
+LOGIN = "h&f"
+
+
+def make_storage() -> Storage:
+    store = Storage(socket_timeout=1, socket_connect_timeout=1)
+    store.client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    for cid in range(10):
+        store.client.set(f"i:{cid}", json.dumps(["books", "music"]))
+    return store
+
+
+def make_body(method: str, arguments: Dict[str, Any], login: str = LOGIN):
+    if login == api.ADMIN_LOGIN:
+        msg = datetime.datetime.now().strftime("%Y%m%d%H") + api.ADMIN_SALT
+    else:
+        msg = ACCOUNT + login + api.SALT
+    return {
+        "account": ACCOUNT,
+        "login": login,
+        "method": method,
+        "token": hashlib.sha512(msg.encode("utf-8")).hexdigest(),
+        "arguments": arguments,
+    }
+
+
+SCORE_ARGUMENTS = {
+    "phone": "79175002040",
+    "email": "stupnikov@otus.ru",
+    "gender": 1,
+    "birthday": "01.01.2000",
+    "first_name": "a",
+    "last_name": "b",
+}
+INTERESTS_ARGUMENTS = {"client_ids": list(range(10)), "date": "20.07.2017"}
+
+
+def validate(request_class, body: Dict[str, Any]) -> Callable[[], Any]:
+    return lambda: request_class(body).validate()
+
+
+def check_auth(login: str) -> Callable[[], Any]:
+    request = api.MethodRequest(make_body("online_score", {}, login))
+    request.validate()
+    return lambda: api.check_auth(request)
+
+
+def get_score_hit(store: Storage) -> Callable[[], Any]:
+    scoring.get_score(store, "79175002040", "stupnikov@otus.ru")
+    return lambda: scoring.get_score(store, "79175002040", "stupnikov@otus.ru")
+
+
+def get_score_miss(store: Storage) -> Callable[[], Any]:
+    names = (str(i) for i in itertools.count())
+    return lambda: scoring.get_score(
+        store, "79175002040", "stupnikov@otus.ru", first_name=next(names)
+    )
+
+
+def method_handler(store: Storage, method: str, arguments) -> Callable[[], Any]:
+    request = {"body": make_body(method, arguments), "headers": {}}
+    return lambda: api.method_handler(request, {}, store)
+
+
+def get_benchmarks() -> Dict[str, Callable[[], Any]]:
+    store = make_storage()
+    birthday = datetime.date(2000, 1, 1)
+    return {
+        "validate_method_request": validate(
+            api.MethodRequest, make_body("online_score", SCORE_ARGUMENTS)
+        ),
+        "validate_online_score": validate(api.OnlineScoreRequest, SCORE_ARGUMENTS),
+        "validate_clients_interests": validate(
+            api.ClientsInterestsRequest, INTERESTS_ARGUMENTS
+        ),
+        "check_auth_admin": check_auth(api.ADMIN_LOGIN),
+        "check_auth_user": check_auth(LOGIN),
+        "get_key": lambda: scoring.get_key("79175002040", birthday, "a", "b"),
+        "get_score_hit": get_score_hit(store),
+        "get_score_miss": get_score_miss(store),
+        "get_interests": lambda: scoring.get_interests(store, 1),
+        "method_handler_online_score": method_handler(
+            store, "online_score", SCORE_ARGUMENTS
+        ),
+        "method_handler_clients_interests": method_handler(
+            store, "clients_interests", INTERESTS_ARGUMENTS
+        ),
+    }
+
+
+def calibration() -> None:
+    total = 0
+    for i in range(1000):
+        total += i * i
+    hashlib.md5(str(total).encode()).hexdigest()
+
+
+def measure(func: Callable[[], Any], repeat: int) -> Dict[str, float]:
+    """Best time of a single call in microseconds and relative to calibration.
+
+    Calibration is timed right before every repeat, so that both best times
+    come from the same state of the machine. A busy machine or a gc pause
+    only ever slows a repeat down, so the best of many short repeats is the
+    stable estimate; the baseline is recorded the same way.
+    """
+    timer, calibration_timer = timeit.Timer(func), timeit.Timer(calibration)
+    # autorange aims at 0.2s, a quarter of that per repeat is enough
+    number = max(1, timer.autorange()[0] // 4)
+    calibration_number = max(1, calibration_timer.autorange()[0] // 4)
+    best, best_calibration = float("inf"), float("inf")
+    for _ in range(repeat):
+        calibration_time = calibration_timer.timeit(calibration_number)
+        best_calibration = min(best_calibration, calibration_time / calibration_number)
+        best = min(best, timer.timeit(number) / number)
+    return {"us": round(best * 1e6, 3), "relative": round(best / best_calibration, 4)}
+
+
+def run(names: List[str], repeat: int) -> Dict[str, Dict[str, float]]:
+    benchmarks = get_benchmarks()
+    return {name: measure(benchmarks[name], repeat) for name in names}
+
+
+def compare(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float,
+) -> List[Tuple[str, float]]:
+    """Return (name, relative slowdown) of benchmarks slower than threshold"""
+    regressions = []
+    for name, current in results.items():
+        if name not in baseline:
+            continue
+        slowdown = current["relative"] / baseline[name]["relative"] - 1
+        if slowdown > threshold:
+            regressions.append((name, slowdown))
+    return regressions
+
+
+if __name__ == "__main__":
+    op = OptionParser()
+    op.add_option("-b", "--baseline", action="store", default=BASELINE_FILE)
+    op.add_option(
+        "-t",
+        "--threshold",
+        action="store",
+        type=float,
+        default=0.25,
+        help="allowed relative slowdown against the baseline",
+    )
+    op.add_option("-r", "--repeat", action="store", type=int, default=15)
+    op.add_option(
+        "-k", "--filter", action="store", default="", help="run matching benchmarks"
+    )
+    op.add_option(
+        "-u",
+        "--update",
+        action="store_true",
+        default=False,
+        help="store results as the new baseline",
+    )
+    (opts, args) = op.parse_args()
+    names = [name for name in get_benchmarks() if opts.filter in name]
+    results = run(names, opts.repeat)
+    if opts.update:
+        with open(opts.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline is saved to {opts.baseline}")
+        sys.exit(0)
+    with open(opts.baseline) as f:
+        baseline = json.load(f)
+    for name, current in results.items():
+        change = "new"
+        if name in baseline:
+            change = f"{current['relative'] / baseline[name]['relative'] - 1:+.1%}"
+        print(f"{name:40} {current['us']:12.3f} us {change:>8}")
+    regressions = compare(results, baseline, opts.threshold)
+    for name, slowdown in regressions:
+        print(f"REGRESSION {name}: {slowdown:.1%} slower than baseline")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""Bloom filter of client ids that have `i:<cid>` interests records"""
+
+import fcntl
+import hashlib
+import logging
+import math
+import os
+import struct
+import threading
+import time
+from optparse import OptionParser
+from typing import Any, Callable, Dict, Iterable, Optional
+
+import redis
+
+import scoring
+
+# magic, size, hashes, count, interests generation
+HEADER = struct.Struct("<4sQQQQ")
+MAGIC = b"BLM2"
+# files written before the generation was saved
+HEADER_V1 = struct.Struct("<4sQQQ")
+MAGIC_V1 = b"BLM1"
+KEY_PREFIX = "i:"
+# bits set in every byte value, see BloomFilter.estimated_count
+BIT_COUNTS = bytes(bin(byte).count("1") for byte in range(256))
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(capacity, 1)
+        self.size = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+        # interests generation (scoring.INTERESTS_GENERATION_KEY) the filter
+        # has every written client id of
+        self.generation = 0
+
+    def positions(self, item: Any) -> Iterable[int]:
+        # double hashing: k positions out of two halves of a single digest
+        digest = hashlib.blake2b(str(item).encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, item: Any, generation: Optional[int] = None) -> None:
+        for pos in self.positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+        if generation is not None:
+            self.generation = max(self.generation, generation)
+
+    def __contains__(self, item: Any) -> bool:
+        bits = self.bits
+        return all(bits[pos >> 3] & (1 << (pos & 7)) for pos in self.positions(item))
+
+    def estimated_count(self, fallback: int) -> int:
+        """Number of distinct items added, estimated from the bits set"""
+        ones = sum(self.bits.translate(BIT_COUNTS))
+        if ones >= self.size:
+            return fallback
+        return round(-self.size / self.hashes * math.log(1 - ones / self.size))
+
+    @property
+    def false_positive_rate(self) -> float:
+        """Expected rate of false positives for the number of added items"""
+        return (1 - math.exp(-self.hashes * self.count / self.size)) ** self.hashes
+
+    def save(self, path: str, merge: bool = False) -> None:
+        """Write the filter to path atomically.
+
+        With merge, ids saved to the file by other processes meanwhile are
+        added to this filter first, so that writers don't drop each other's ids.
+        """
+        with open(f"{path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if merge and os.path.exists(path):
+                self.merge(BloomFilter.load(path))
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(
+                    HEADER.pack(
+                        MAGIC, self.size, self.hashes, self.count, self.generation
+                    )
+                )
+                f.write(self.bits)
+            os.replace(tmp_path, path)
+
+    def merge(self, other: "BloomFilter") -> None:
+        if (other.size, other.hashes) != (self.size, self.hashes):
+            raise ValueError("Bloom filters of different sizes can't be merged")
+        bits = int.from_bytes(self.bits, "little") | int.from_bytes(
+            other.bits, "little"
+        )
+        self.bits = bytearray(bits.to_bytes(len(self.bits), "little"))
+        # ids added to both are not known, the union is estimated from its bits
+        self.count = self.estimated_count(fallback=self.count + other.count)
+        self.generation = max(self.generation, other.generation)
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        with open(path, "rb") as f:
+            data = f.read()
+        bloom = cls.__new__(cls)
+        if data[:4] == MAGIC:
+            header = HEADER.unpack_from(data)
+            bloom.size, bloom.hashes, bloom.count, bloom.generation = header[1:]
+            bloom.bits = bytearray(data[HEADER.size :])
+        elif data[:4] == MAGIC_V1:
+            bloom.size, bloom.hashes, bloom.count = HEADER_V1.unpack_from(data)[1:]
+            bloom.generation = 0
+            bloom.bits = bytearray(data[HEADER_V1.size :])
+        else:
+            raise ValueError(f"{path} is not a bloom filter")
+        return bloom
+
+
+class BloomFilterFile:
+    """Bloom filter which is reloaded once its file is rewritten.
+
+    Writers in other processes save the filter after adding ids, without
+    the reload this worker would keep answering `[]` for new clients. Ids
+    added here are saved SAVE_DELAY seconds later along with the ones added
+    meanwhile, and added to every reloaded filter until they are saved.
+
+    With generation_source, the filter is also compared with the interests
+    generation in redis on every check: while it is behind, e.g. interests
+    were loaded without adding their ids to the file, every id may be
+    present, so that lookups go to storage instead of answering `[]`.
+    """
+
+    CHECK_INTERVAL = 5
+    SAVE_DELAY = 1
+
+    def __init__(
+        self, path: str, generation_source: Optional[Callable[[], int]] = None
+    ):
+        self.path = path
+        self.lock = threading.Lock()
+        self.bloom = BloomFilter.load(path)
+        self.mtime = os.stat(path).st_mtime_ns
+        self.checked_at = time.monotonic()
+        # id -> generation it was added at, for ids not saved to the file yet
+        self.unsaved: Dict[Any, Optional[int]] = {}
+        self.save_timer: Optional[threading.Timer] = None
+        self.generation_source = generation_source
+        self.behind = False
+
+    def maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self.checked_at < self.CHECK_INTERVAL:
+            return
+        with self.lock:
+            if now - self.checked_at < self.CHECK_INTERVAL:
+                return
+            self.checked_at = now
+            try:
+                mtime = os.stat(self.path).st_mtime_ns
+                if mtime != self.mtime:
+                    bloom = BloomFilter.load(self.path)
+                    for item, generation in self.unsaved.items():
+                        bloom.add(item, generation)
+                    self.bloom, self.mtime = bloom, mtime
+                    logging.info(f"Loaded interests filter {self.path}")
+            except (OSError, ValueError) as e:
+                logging.info(f"Interests filter is not reloaded: {e}")
+            self.check_generation()
+
+    def check_generation(self) -> None:
+        if self.generation_source is None:
+            return
+        try:
+            generation = self.generation_source()
+        except redis.exceptions.RedisError as e:
+            logging.info(f"Interests generation is not checked: {e}")
+            return
+        behind = self.bloom.generation < generation
+        if behind != self.behind:
+            logging.info(
+                f"Interests filter is at generation {self.bloom.generation}, "
+                f"interests are at {generation}, "
+                + ("bypassing it" if behind else "using it again")
+            )
+        self.behind = behind
+
+    def add(self, item: Any, generation: Optional[int] = None) -> None:
+        with self.lock:
+            self.bloom.add(item, generation)
+            self.unsaved[item] = generation
+            if self.save_timer is None:
+                self.save_timer = threading.Timer(self.SAVE_DELAY, self.save_added)
+                self.save_timer.daemon = True
+                self.save_timer.start()
+
+    def __contains__(self, item: Any) -> bool:
+        self.maybe_reload()
+        return self.behind or item in self.bloom
+
+    @property
+    def false_positive_rate(self) -> float:
+        return self.bloom.false_positive_rate
+
+    @property
+    def generation(self) -> int:
+        return self.bloom.generation
+
+    def save(self) -> None:
+        with self.lock:
+            self.bloom.save(self.path, merge=True)
+            self.mtime = os.stat(self.path).st_mtime_ns
+            self.unsaved.clear()
+
+    def save_added(self) -> None:
+        """Save ids added since the last save, run by the save timer"""
+        with self.lock:
+            self.save_timer = None
+        try:
+            self.save()
+        except (OSError, ValueError) as e:
+            logging.info(f"Interests filter is not saved: {e}")
+
+
+def get_generation(client: redis.Redis) -> int:
+    return int(client.get(scoring.INTERESTS_GENERATION_KEY) or 0)
+
+
+def scan_client_ids(client: redis.Redis) -> Iterable[int]:
+    for key in client.scan_iter(match=f"{KEY_PREFIX}*", count=1000):
+        cid = key.decode()[len(KEY_PREFIX) :]
+        if cid.isdigit():
+            yield int(cid)
+
+
+def build_from_redis(
+    client: redis.Redis, error_rate: float = 0.01, headroom: float = 2.0
+) -> BloomFilter:
+    """Build a filter over existing keys, sized to keep error rate after growth"""
+    bloom = BloomFilter(int(client.dbsize() * headroom), error_rate)
+    # ids written during the scan may be missed, they have a later generation
+    bloom.generation = get_generation(client)
+    for cid in scan_client_ids(client):
+        bloom.add(cid)
+    return bloom
+
+
+def open_filter(
+    client: redis.Redis, path: str, error_rate: float = 0.01
+) -> BloomFilterFile:
+    """Filter file, (re)built when missing or older than interests in redis.
+
+    A file is older when interests were written without adding their ids
+    to it, e.g. by a process running without the filter: it would answer
+    `[]` for some clients that have interests.
+    """
+    stale = not os.path.exists(path)
+    if not stale:
+        generation, saved = get_generation(client), BloomFilter.load(path).generation
+        stale = saved < generation
+        if stale:
+            logging.info(
+                f"Interests filter {path} is at generation {saved}, "
+                f"interests are at {generation}, rebuilding it"
+            )
+    if stale:
+        build_from_redis(client, error_rate).save(path)
+    return BloomFilterFile(path, lambda: get_generation(client))
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog -o interests.bloom")
+    op.add_option("-o", "--output", action="store", default="interests.bloom")
+    op.add_option("-e", "--error-rate", action="store", type=float, default=0.01)
+    (opts, args) = op.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname).1s %(message)s",
+        datefmt="%Y.%m.%d %H:%M:%S",
+    )
+    started = time.monotonic()
+    bloom = build_from_redis(redis.Redis(), opts.error_rate)
+    bloom.save(opts.output)
+    logging.info(
+        "Built %s with %s clients in %.1fs, false positive rate %.4f"
+        % (
+            opts.output,
+            bloom.count,
+            time.monotonic() - started,
+            bloom.false_positive_rate,
+        )
+    )
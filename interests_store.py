@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""Read-only interests snapshot served from a memory-mapped file.
+
+File layout (little endian):
+    header  - magic, format version, number of clients
+    index   - (client_id, payload offset, payload length) sorted by client_id
+    payload - json encoded interests lists, one after another
+"""
+
+import json
+import logging
+import mmap
+import os
+import shutil
+import struct
+import threading
+import time
+from optparse import OptionParser
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import redis
+
+MAGIC = b"INTR"
+VERSION = 1
+HEADER = struct.Struct("<4sIQ")
+ENTRY = struct.Struct("<qQI")
+KEY_PREFIX = "i:"
+
+
+class Snapshot:
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.version = (stat.st_ino, stat.st_mtime_ns)
+        magic, version, self.count = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not an interests snapshot")
+        self.payload_start = HEADER.size + self.count * ENTRY.size
+
+    def entry(self, pos: int) -> Tuple[int, int, int]:
+        return ENTRY.unpack_from(self.mm, HEADER.size + pos * ENTRY.size)
+
+    def lookup(self, cid: int) -> Optional[memoryview]:
+        # binary search right over the mapped index, nothing is loaded upfront
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            mid_cid, offset, length = self.entry(mid)
+            if mid_cid < cid:
+                lo = mid + 1
+            elif mid_cid > cid:
+                hi = mid
+            else:
+                start = self.payload_start + offset
+                # a view into the mapping, the payload is not copied
+                return memoryview(self.mm)[start : start + length]
+        return None
+
+
+class MmapInterestsStore:
+    """Storage.get compatible backend for `i:<cid>` keys.
+
+    The snapshot file is re-checked every CHECK_INTERVAL seconds and mapped
+    again once it was replaced, so a new snapshot built next to the old one
+    and renamed over it is picked up without restart.
+    """
+
+    CHECK_INTERVAL = 5
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.snapshot = Snapshot(path)
+        self.checked_at = time.monotonic()
+
+    def reload(self) -> bool:
+        stat = os.stat(self.path)
+        if (stat.st_ino, stat.st_mtime_ns) == self.snapshot.version:
+            return False
+        # lookups in flight keep a reference to the old snapshot,
+        # its mapping is released once they are done
+        self.snapshot = Snapshot(self.path)
+        logging.info(f"Loaded interests snapshot {self.path}")
+        return True
+
+    def maybe_reload(self) -> None:
+        now = time.monotonic()
+        if now - self.checked_at < self.CHECK_INTERVAL:
+            return
+        with self.lock:
+            if now - self.checked_at < self.CHECK_INTERVAL:
+                return
+            self.checked_at = now
+            try:
+                self.reload()
+            except (OSError, ValueError) as e:
+                logging.info(f"Interests snapshot is not reloaded: {e}")
+
+    def get(self, key: str, deadline: Optional[float] = None) -> Optional[memoryview]:
+        # local lookups are bounded, the deadline is accepted for Storage parity
+        self.maybe_reload()
+        if not key.startswith(KEY_PREFIX):
+            return None
+        try:
+            cid = int(key[len(KEY_PREFIX) :])
+        except ValueError:
+            return None
+        return self.snapshot.lookup(cid)
+
+
+def build_snapshot(records: Iterable[Tuple[int, bytes]], path: str) -> int:
+    """Write (client_id, json payload) records to a snapshot file atomically.
+
+    Payloads are streamed to a scratch file in the order they come, only the
+    index is kept in memory to be sorted and written in front of them.
+    """
+    tmp_path, payload_path = f"{path}.tmp", f"{path}.payload"
+    index: List[Tuple[int, int, int]] = []
+    try:
+        with open(payload_path, "wb") as payload:
+            offset = 0
+            for cid, value in records:
+                payload.write(value)
+                index.append((cid, offset, len(value)))
+                offset += len(value)
+        # the last record of a client wins, as it would in a dict
+        index.sort(key=lambda entry: entry[0])
+        entries = [
+            entry
+            for pos, entry in enumerate(index)
+            if pos + 1 == len(index) or index[pos + 1][0] != entry[0]
+        ]
+        with open(tmp_path, "wb") as f, open(payload_path, "rb") as payload:
+            f.write(HEADER.pack(MAGIC, VERSION, len(entries)))
+            for entry in entries:
+                f.write(ENTRY.pack(*entry))
+            shutil.copyfileobj(payload, f)
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        if os.path.exists(payload_path):
+            os.remove(payload_path)
+    os.replace(tmp_path, path)
+    return len(entries)
+
+
+def read_jsonl(path: str) -> Iterator[Tuple[int, bytes]]:
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield int(record["client_id"]), json.dumps(record["interests"]).encode()
+
+
+def read_redis(client: redis.Redis) -> Iterator[Tuple[int, bytes]]:
+    for key in client.scan_iter(match=f"{KEY_PREFIX}*", count=1000):
+        cid = key.decode()[len(KEY_PREFIX) :]
+        value = client.get(key)
+        if cid.isdigit() and value is not None:
+            yield int(cid), value
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog -o interests.db [-i interests.jsonl]")
+    op.add_option(
+        "-i",
+        "--input",
+        action="store",
+        default=None,
+        help="jsonl with client_id and interests, dump redis `i:` keys if omitted",
+    )
+    op.add_option("-o", "--output", action="store", default="interests.db")
+    (opts, args) = op.parse_args()
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname).1s %(message)s",
+        datefmt="%Y.%m.%d %H:%M:%S",
+    )
+    source = read_jsonl(opts.input) if opts.input else read_redis(redis.Redis())
+    started = time.monotonic()
+    total = build_snapshot(source, opts.output)
+    logging.info(
+        "Built %s with %s clients in %.1fs"
+        % (opts.output, total, time.monotonic() - started)
+    )
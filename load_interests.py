@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""Bulk load `i:<cid>` interests records into redis.
+
+Input is csv with `client_id,interests` columns, where interests are a json
+list or `;` separated, or jsonl with client_id and interests. Rows are
+written in MSET batches by several threads. The number of rows written so
+far is saved to a checkpoint file, a restarted load skips them.
+"""
+
+import csv
+import itertools
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
+
+import bloom
+import scoring
+from storage import Storage
+
+Row = Tuple[int, str]
+
+
+def parse_interests(value: str) -> List[str]:
+    value = value.strip()
+    if value.startswith("["):
+        return json.loads(value)
+    return [item.strip() for item in value.split(";") if item.strip()]
+
+
+def read_csv(source: TextIO) -> Iterator[Row]:
+    for record in csv.DictReader(source):
+        interests = parse_interests(record["interests"])
+        yield int(record["client_id"]), json.dumps(interests)
+
+
+def read_jsonl(source: TextIO) -> Iterator[Row]:
+    for line in source:
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        yield int(record["client_id"]), json.dumps(record["interests"])
+
+
+def read_checkpoint(path: Optional[str]) -> int:
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        return json.load(f)["rows"]
+
+
+def write_checkpoint(path: str, rows: int) -> None:
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"rows": rows}, f)
+    os.replace(tmp_path, path)
+
+
+def load(
+    rows: Iterable[Row],
+    store: Storage,
+    batch_size: int = 1000,
+    workers: int = 4,
+    checkpoint: Optional[str] = None,
+    checkpoint_every: int = 10,
+    interests_filter: Optional[bloom.BloomFilter] = None,
+    filter_path: Optional[str] = None,
+) -> int:
+    """Write rows to storage, return the number of rows loaded in total"""
+    done = read_checkpoint(checkpoint)
+    rows = itertools.islice(rows, done, None)
+    if done:
+        logging.info(f"Resuming after {done} rows")
+    loaded, started = 0, time.monotonic()
+
+    def save_progress() -> None:
+        # the filter goes first: a checkpoint must not point past ids it misses
+        if interests_filter is not None and filter_path:
+            interests_filter.save(filter_path, merge=True)
+        if checkpoint:
+            write_checkpoint(checkpoint, done)
+        elapsed = max(time.monotonic() - started, 1e-9)
+        logging.info("Loaded %s rows, %.0f rows/s" % (done, loaded / elapsed))
+
+    def write_batch(batch: List[Row]) -> int:
+        # recorded as of today, so that the history before the load is kept;
+        # the generation is bumped once the load is over, not on every batch
+        scoring.write_interests(store, dict(batch), bump_generation=False)
+        return len(batch)
+
+    with ThreadPoolExecutor(workers) as pool:
+        # batches finish in any order, but progress only counts the ones
+        # written without gaps from the start, so they are awaited in order
+        pending, batches = deque(), 0
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if batch:
+                if interests_filter is not None:
+                    for cid, _ in batch:
+                        interests_filter.add(cid)
+                pending.append(pool.submit(write_batch, batch))
+            if pending and (not batch or len(pending) >= workers * 2):
+                written = pending.popleft().result()
+                done, loaded, batches = done + written, loaded + written, batches + 1
+                if batches % checkpoint_every == 0:
+                    save_progress()
+            if not batch and not pending:
+                break
+    generation = scoring.bump_interests_generation(store)
+    if interests_filter is not None:
+        # the filter has every loaded id by now
+        interests_filter.generation = max(interests_filter.generation, generation)
+    save_progress()
+    return done
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] interests.csv|interests.jsonl")
+    op.add_option("-b", "--batch-size", action="store", type=int, default=1000)
+    op.add_option("-w", "--workers", action="store", type=int, default=4)
+    op.add_option(
+        "-c",
+        "--checkpoint",
+        action="store",
+        default=None,
+        help="file to save progress to and resume from",
+    )
+    op.add_option(
+        "--checkpoint-every",
+        action="store",
+        type=int,
+        default=10,
+        help="save progress every N batches",
+    )
+    op.add_option(
+        "--filter",
+        action="store",
+        default=None,
+        help="interests bloom filter file to add loaded client ids to",
+    )
+    op.add_option("--filter-capacity", action="store", type=int, default=10**7)
+    (opts, args) = op.parse_args()
+    if len(args) != 1:
+        op.error("exactly one input file is required")
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname).1s %(message)s",
+        datefmt="%Y.%m.%d %H:%M:%S",
+    )
+    interests_filter = None
+    if opts.filter:
+        if os.path.exists(opts.filter):
+            interests_filter = bloom.BloomFilter.load(opts.filter)
+        else:
+            interests_filter = bloom.BloomFilter(opts.filter_capacity)
+    store = Storage(socket_timeout=60, socket_connect_timeout=10)
+    path = args[0]
+    with open(path, newline="") as source:
+        rows = read_jsonl(source) if path.endswith(".jsonl") else read_csv(source)
+        load(
+            rows,
+            store,
+            opts.batch_size,
+            opts.workers,
+            opts.checkpoint,
+            opts.checkpoint_every,
+            interests_filter,
+            opts.filter,
+        )
@@ -0,0 +1,124 @@
+import gc
+import logging
+import resource
+import signal
+import threading
+import time
+import tracemalloc
+from typing import Any, Dict, List, Optional
+
+IGNORED_TRACES = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+
+def get_rss() -> int:
+    """Current resident set size in bytes"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        # no procfs, fall back to the peak value
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def get_gc_stats() -> Dict[str, Any]:
+    return {
+        "counts": gc.get_count(),
+        "collections": [stats["collections"] for stats in gc.get_stats()],
+        "collected": [stats["collected"] for stats in gc.get_stats()],
+        "uncollectable": len(gc.garbage),
+        "objects": len(gc.get_objects()),
+    }
+
+
+class MemoryWatcher:
+    """tracemalloc snapshots with growth since the previous report"""
+
+    def __init__(self, frames: int = 1, top: int = 10):
+        self.frames = frames
+        self.top = top
+        self.lock = threading.Lock()
+        self.previous: Optional[tracemalloc.Snapshot] = None
+        self.previous_rss: Optional[int] = None
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self.previous = None
+
+    @staticmethod
+    def format_stats(stats: List[tracemalloc.Statistic]) -> List[Dict[str, Any]]:
+        return [
+            {
+                "site": str(stat.traceback),
+                "size": stat.size,
+                "count": stat.count,
+                # plain statistics of the first snapshot have nothing to compare to
+                "size_diff": getattr(stat, "size_diff", 0),
+                "count_diff": getattr(stat, "count_diff", 0),
+            }
+            for stat in stats
+        ]
+
+    def report(self, top: Optional[int] = None) -> Dict[str, Any]:
+        top = top or self.top
+        rss = get_rss()
+        result = {"rss": rss, "gc": get_gc_stats()}
+        with self.lock:
+            if self.previous_rss is not None:
+                result["rss_diff"] = rss - self.previous_rss
+            self.previous_rss = rss
+            if not tracemalloc.is_tracing():
+                return result
+            snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED_TRACES)
+            result["traced"], result["traced_peak"] = tracemalloc.get_traced_memory()
+            if self.previous is None:
+                stats = snapshot.statistics("lineno")
+            else:
+                stats = snapshot.compare_to(self.previous, "lineno")
+            result["top"] = self.format_stats(stats[:top])
+            self.previous = snapshot
+        return result
+
+    def log_report(self) -> None:
+        report = self.report()
+        logging.info(
+            "Memory: rss %s (%+d), traced %s"
+            % (report["rss"], report.get("rss_diff", 0), report.get("traced", "-"))
+        )
+        for stat in report.get("top", []):
+            logging.info(
+                "Memory: %s size %s (%+d) count %s (%+d)"
+                % (
+                    stat["site"],
+                    stat["size"],
+                    stat["size_diff"],
+                    stat["count"],
+                    stat["count_diff"],
+                )
+            )
+
+    def install_signal_handler(self, signum: int = signal.SIGUSR1) -> None:
+        signal.signal(signum, lambda *_: self.log_report())
+
+    def start_periodic(self, interval: float) -> threading.Thread:
+        def log_forever():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.log_report()
+                except Exception as e:
+                    logging.exception("Memory report failed: %s" % e)
+
+        thread = threading.Thread(target=log_forever, name="memwatch", daemon=True)
+        thread.start()
+        return thread
+
+
+watcher = MemoryWatcher()
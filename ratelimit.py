@@ -0,0 +1,207 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+import redis
+
+# KEYS[1] - bucket key, ARGV - rate (tokens/sec), burst, current unix time
+TOKEN_BUCKET_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def consume(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def refilled(self, now: float) -> bool:
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+
+class LocalRateLimiter:
+    """In-process token bucket per key, suitable for a single worker.
+
+    Past MAX_KEYS, least recently seen keys are forgotten once their buckets
+    have refilled: a forgotten key starts over with a full bucket, so
+    throttled keys are kept, even beyond MAX_KEYS, until they refill.
+    """
+
+    MAX_KEYS = 100000
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def allow(self, key: str) -> bool:
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, self.burst)
+                now = time.monotonic()
+                # least recently seen first, so the ones after a throttled
+                # bucket were updated later and can't have refilled sooner
+                while len(self.buckets) > self.MAX_KEYS:
+                    if not next(iter(self.buckets.values())).refilled(now):
+                        break
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            return bucket.consume()
+
+
+class RedisRateLimiter:
+    """Token bucket per key shared by all workers, updated atomically in redis"""
+
+    def __init__(self, client: redis.Redis, rate: float, burst: int, prefix="rl:"):
+        self.rate = rate
+        self.burst = burst
+        self.prefix = prefix
+        self.script = client.register_script(TOKEN_BUCKET_SCRIPT)
+
+    def allow(self, key: str) -> bool:
+        try:
+            return bool(
+                self.script(
+                    keys=[self.prefix + key], args=[self.rate, self.burst, time.time()]
+                )
+            )
+        except redis.exceptions.RedisError as e:
+            # fail open: rate limiting must not take the api down with redis
+            logging.info(f"Rate limiter is unavailable: {e}")
+            return True
+
+
+class LoadShedder:
+    """Reject work once the number of in-flight requests exceeds the limit"""
+
+    def __init__(self, max_inflight: int = 0):
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> bool:
+        with self.lock:
+            if self.max_inflight and self.inflight >= self.max_inflight:
+                return False
+            self.inflight += 1
+            return True
+
+    def release(self) -> None:
+        with self.lock:
+            self.inflight -= 1
+
+
+class Lane:
+    """Bulkhead for a kind of requests: a few run at once, a few more wait.
+
+    Requests are executed by the threads that accepted them, a lane only
+    limits how many of them run and queue, so a spike of heavy requests
+    waits (or is refused) in its own lane without taking threads, redis
+    connections and cpu away from the others.
+    """
+
+    def __init__(self, name: str, workers: int, queue_size: int = 0):
+        self.name = name
+        self.workers = workers
+        self.queue_size = queue_size
+        self.semaphore = threading.BoundedSemaphore(workers)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def acquire(self, timeout: float = float("inf")) -> Optional[float]:
+        """Seconds waited for a free worker, None when refused or timed out"""
+        waited = 0.0
+        if not self.semaphore.acquire(blocking=False):
+            started = time.monotonic()
+            with self.lock:
+                if self.waiting >= self.queue_size:
+                    self.rejected += 1
+                    return None
+                self.waiting += 1
+            acquired = timeout > 0 and self.semaphore.acquire(
+                timeout=None if timeout == float("inf") else timeout
+            )
+            with self.lock:
+                self.waiting -= 1
+                if not acquired:
+                    self.timed_out += 1
+                    return None
+            waited = time.monotonic() - started
+        with self.lock:
+            self.running += 1
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+        return waited
+
+    def release(self) -> None:
+        with self.lock:
+            self.running -= 1
+            self.completed += 1
+        self.semaphore.release()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            started = self.completed + self.running
+            return {
+                "workers": self.workers,
+                "queue_size": self.queue_size,
+                "running": self.running,
+                "waiting": self.waiting,
+                "completed": self.completed,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "wait_ms": {
+                    "avg": round(self.wait_total / max(started, 1) * 1000, 3),
+                    "max": round(self.wait_max * 1000, 3),
+                },
+            }
+
+    @classmethod
+    def parse(cls, spec: str) -> "Lane":
+        """Lane from `name=workers[:queue_size]`"""
+        error = f"Invalid lane {spec!r}, expected name=workers[:queue]"
+        try:
+            name, limits = spec.split("=", 1)
+            workers, _, queue_size = limits.partition(":")
+            lane = cls(name.strip(), int(workers), int(queue_size or 0))
+        except ValueError:
+            raise ValueError(error)
+        if not lane.name or lane.workers < 1 or lane.queue_size < 0:
+            raise ValueError(error)
+        return lane
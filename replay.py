@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+"""Replay requests from api.py logs against a server.
+
+Understands the plain log written by api.py, where every request is logged
+as `<path>: <raw body> <request id>` and then its context with the response,
+and jsonl with {"time", "path", "body", "request_id", "code", "response"}
+objects. Requests are sent at the original pace, faster or as fast as
+possible, responses are compared with the logged ones.
+"""
+
+import ast
+import datetime
+import hashlib
+import http.client
+import json
+import logging
+import re
+import sys
+import threading
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import api
+import batch_score
+import scoring
+
+LOG_LINE = re.compile(r"^\[(?P<time>[\d.]+ [\d:]+)\] I (?P<message>.*)$")
+TIME_FORMAT = "%Y.%m.%d %H:%M:%S"
+
+
+class Event(NamedTuple):
+    time: float
+    path: str
+    body: bytes
+    request_id: str
+    # logged response envelope, None when the log has no context line for it
+    expected: Optional[Dict[str, Any]] = None
+
+
+class Result(NamedTuple):
+    event: Event
+    latency: float
+    code: Optional[int]
+    response: Optional[Dict[str, Any]]
+    error: Optional[str] = None
+
+
+def envelope(context: Dict[str, Any]) -> Dict[str, Any]:
+    """Response part of a logged context, normalized as it looks in json"""
+    keys = ("code", "response", "error")
+    return json.loads(json.dumps({k: context[k] for k in keys if k in context}))
+
+
+def skip(skipped: Optional[Dict[str, int]], kind: str) -> None:
+    if skipped is not None:
+        skipped[kind] = skipped.get(kind, 0) + 1
+
+
+def bytes_literal_end(text: str) -> Optional[int]:
+    """End of the bytes repr text starts with, None when it is not one"""
+    if text[:1] != "b" or text[1:2] not in ("'", '"'):
+        return None
+    quote, i = text[1], 2
+    while i < len(text):
+        if text[i] == "\\":
+            i += 2
+        elif text[i] == quote:
+            return i + 1
+        else:
+            i += 1
+    return None
+
+
+def parse_request_message(message: str) -> Optional[Tuple[str, bytes, str]]:
+    """Path, body and request id of a `<path>: <raw body> <request id>` message.
+
+    The id comes from the X-Request-Id header and may hold anything, spaces
+    included, so the message is split around the body: the first `: b'...'`
+    that is a whole bytes repr followed by a space.
+    """
+    start = message.find(": b")
+    while start != -1:
+        rest = message[start + 2 :]
+        end = bytes_literal_end(rest)
+        if end is not None and rest[end : end + 1] == " ":
+            try:
+                body = ast.literal_eval(rest[:end])
+            except (ValueError, SyntaxError):
+                body = None
+            if isinstance(body, bytes):
+                return message[:start], body, rest[end + 1 :]
+        start = message.find(": b", start + 1)
+    return None
+
+
+def parse_plain_log(
+    lines: Iterable[str], skipped: Optional[Dict[str, int]] = None
+) -> List[Event]:
+    """Requests of the log, lines that can't be parsed are counted in skipped"""
+    events, contexts = [], {}
+    for line in lines:
+        match = LOG_LINE.match(line.rstrip("\n"))
+        if not match:
+            continue
+        ts = datetime.datetime.strptime(match["time"], TIME_FORMAT).timestamp()
+        message = match["message"]
+        if message.startswith("/"):
+            request = parse_request_message(message)
+            if request is None:
+                skip(skipped, "request")
+                continue
+            events.append(Event(ts, *request))
+        elif message.startswith("{"):
+            try:
+                context = ast.literal_eval(message)
+            except (ValueError, SyntaxError):
+                context = None
+            if isinstance(context, dict) and "request_id" in context:
+                contexts[context["request_id"]] = envelope(context)
+            else:
+                skip(skipped, "context")
+    return [e._replace(expected=contexts.get(e.request_id)) for e in events]
+
+
+def parse_jsonl(
+    lines: Iterable[str], skipped: Optional[Dict[str, int]] = None
+) -> List[Event]:
+    events = []
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            body = record["body"]
+            if not isinstance(body, str):
+                body = json.dumps(body)
+            expected = envelope(record) if "code" in record else None
+            event = Event(
+                float(record["time"]),
+                record["path"],
+                body.encode("utf-8"),
+                record.get("request_id", ""),
+                expected,
+            )
+        except (ValueError, TypeError, KeyError):
+            skip(skipped, "record")
+            continue
+        events.append(event)
+    return events
+
+
+def parse_log(
+    lines: List[str], skipped: Optional[Dict[str, int]] = None
+) -> List[Event]:
+    first = next((line for line in lines if line.strip()), "")
+    if first.lstrip().startswith("{"):
+        events = parse_jsonl(lines, skipped)
+    else:
+        events = parse_plain_log(lines, skipped)
+    return sorted(events, key=lambda e: e.time)
+
+
+def send(target: str, event: Event, timeout: float) -> Result:
+    url = urllib.parse.urlsplit(target)
+    headers = {"X-Request-Id": event.request_id}
+    try:
+        json.loads(event.body)
+        headers["Content-Type"] = "application/json"
+    except ValueError:
+        headers["Content-Type"] = "application/msgpack"
+    started = time.monotonic()
+    try:
+        conn = http.client.HTTPConnection(url.hostname, url.port, timeout=timeout)
+        conn.request("POST", url.path.rstrip("/") + event.path, event.body, headers)
+        response = conn.getresponse()
+        data = response.read()
+        latency = time.monotonic() - started
+        conn.close()
+    except OSError as e:
+        return Result(event, time.monotonic() - started, None, None, str(e))
+    try:
+        body = json.loads(data)
+    except ValueError:
+        body = None
+    return Result(event, latency, response.status, body)
+
+
+def replay(
+    events: List[Event],
+    target: str,
+    speed: float = 1.0,
+    concurrency: int = 16,
+    timeout: float = 30,
+) -> List[Result]:
+    """Send events keeping their relative timing divided by speed, 0 - no pauses"""
+    if not events:
+        return []
+    results, lock = [], threading.Lock()
+
+    def run(event: Event) -> None:
+        result = send(target, event, timeout)
+        with lock:
+            results.append(result)
+
+    started, first = time.monotonic(), events[0].time
+    with ThreadPoolExecutor(concurrency) as pool:
+        for event in events:
+            if speed > 0:
+                delay = started + (event.time - first) / speed - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            pool.submit(run, event)
+    return results
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))]
+
+
+def diff(result: Result) -> Optional[str]:
+    expected = result.event.expected
+    if expected is None or result.response is None:
+        return None
+    got = {k: v for k, v in result.response.items() if k in expected}
+    if got == expected:
+        return None
+    return f"{result.event.request_id}: expected {expected}, got {result.response}"
+
+
+def summarize(results: List[Result], elapsed: float) -> Dict[str, Any]:
+    latencies = [r.latency * 1000 for r in results if r.error is None]
+    codes = {}
+    for r in results:
+        codes[r.code] = codes.get(r.code, 0) + 1
+    diffs = [d for d in (diff(r) for r in results) if d]
+    return {
+        "requests": len(results),
+        "failed": sum(r.error is not None for r in results),
+        "rps": round(len(results) / elapsed, 1) if elapsed else 0.0,
+        "codes": codes,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 3),
+            "p90": round(percentile(latencies, 90), 3),
+            "p99": round(percentile(latencies, 99), 3),
+            "max": round(max(latencies, default=0.0), 3),
+        },
+        "compared": sum(r.event.expected is not None for r in results),
+        "diffs": diffs,
+    }
+
+
+def legacy_score_key(phone, birthday=None, first_name=None, last_name=None, **_):
+    """scoring.get_key as it was before keys got normalized"""
+    key_parts = [
+        first_name or "",
+        last_name or "",
+        phone or "",
+        birthday.strftime("%Y%m%d") if birthday is not None else "",
+    ]
+    return (
+        "uid:"
+        + hashlib.md5("".join([str(v) for v in key_parts]).encode("utf-8")).hexdigest()
+    )
+
+
+def score_key_hit_rates(
+    events: List[Event], ttl: Optional[int] = None
+) -> Dict[str, Any]:
+    """Simulate the score cache over logged online_score requests.
+
+    Compares legacy and normalized keys: how often a request would hit the
+    cache, and how often the hit would hold a score of somebody else.
+    """
+    ttl = ttl or scoring.SCORE_SOFT_TTL
+    key_funcs = {"legacy": legacy_score_key, "normalized": scoring.get_key}
+    caches = {name: {} for name in key_funcs}
+    stats = {name: {"hits": 0, "wrong_hits": 0} for name in key_funcs}
+    requests = 0
+    for event in events:
+        try:
+            body = json.loads(event.body)
+            if body.get("method") != "online_score" or body.get("login") == "admin":
+                continue
+            person = batch_score.parse_line(json.dumps(body.get("arguments")))
+        except (ValueError, AttributeError, api.CustomValidationError):
+            continue
+        requests += 1
+        score = scoring.compute_score(**person)
+        for name, key_func in key_funcs.items():
+            key = key_func(**person)
+            cached = caches[name].get(key)
+            if cached and event.time - cached[0] < ttl:
+                stats[name]["hits"] += 1
+                stats[name]["wrong_hits"] += cached[1] != score
+            else:
+                caches[name][key] = (event.time, score)
+    for name in stats:
+        stats[name]["hit_rate"] = round(stats[name]["hits"] / max(requests, 1), 4)
+        stats[name]["keys"] = len(caches[name])
+    return dict(stats, requests=requests)
+
+
+if __name__ == "__main__":
+    op = OptionParser(usage="%prog [options] api.log [api.log ...]")
+    op.add_option("-t", "--target", action="store", default="http://localhost:8080")
+    op.add_option(
+        "-s",
+        "--speed",
+        action="store",
+        type=float,
+        default=1.0,
+        help="1 - original timing, 2 - twice as fast, 0 - as fast as possible",
+    )
+    op.add_option("-c", "--concurrency", action="store", type=int, default=16)
+    op.add_option("--timeout", action="store", type=float, default=30)
+    op.add_option(
+        "--key-stats",
+        action="store_true",
+        default=False,
+        help="only compare score cache hit rates of legacy and normalized keys",
+    )
+    op.add_option(
+        "--show-diffs", action="store", type=int, default=10, help="diffs to print"
+    )
+    (opts, args) = op.parse_args()
+    if not args:
+        op.error("at least one log file is required")
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname).1s %(message)s",
+        datefmt=TIME_FORMAT,
+    )
+    events, skipped = [], {}
+    for path in args:
+        with open(path) as f:
+            events.extend(parse_log(f.readlines(), skipped))
+    events.sort(key=lambda e: e.time)
+    if skipped:
+        logging.warning(
+            "Skipped %s unparsable log lines: %s" % (sum(skipped.values()), skipped)
+        )
+    if opts.key_stats:
+        print(json.dumps(dict(score_key_hit_rates(events), skipped=skipped), indent=2))
+        sys.exit(0)
+    logging.info("Replaying %s requests against %s" % (len(events), opts.target))
+    started = time.monotonic()
+    results = replay(events, opts.target, opts.speed, opts.concurrency, opts.timeout)
+    summary = summarize(results, time.monotonic() - started)
+    diffs = summary.pop("diffs")
+    print(json.dumps(dict(summary, diffs=len(diffs), skipped=skipped), indent=2))
+    for line in diffs[: opts.show_diffs]:
+        print(line)
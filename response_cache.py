@@ -0,0 +1,84 @@
+"""Encoded responses of read-only methods cached in redis for a few seconds.
+
+Entries are keyed on a hash of the method, its normalized arguments and
+the response format (content type and encoding). Every entry carries the
+interests generation it was built at; writers of interests bump the
+generation (scoring.bump_interests_generation), which turns all older
+entries into misses without scanning for them.
+"""
+
+import hashlib
+import json
+from typing import Any, Dict, NamedTuple, Optional, Tuple
+
+import scoring
+from storage import Storage
+
+KEY_PREFIX = "rc:"
+
+
+class CachedResponse(NamedTuple):
+    encoding: Optional[str]
+    data: bytes
+
+
+def normalize_arguments(method: str, arguments: Dict[str, Any]) -> Dict[str, Any]:
+    arguments = dict(arguments or {})
+    client_ids = arguments.get("client_ids")
+    # the same clients in any order or repeated get the same response
+    if method == "clients_interests" and isinstance(client_ids, list):
+        if all(type(cid) is int for cid in client_ids):
+            arguments["client_ids"] = sorted(set(client_ids))
+    return arguments
+
+
+class ResponseCache:
+    def __init__(self, store: Storage, ttl: int = 5, methods=("clients_interests",)):
+        self.store = store
+        self.ttl = ttl
+        self.methods = set(methods)
+
+    def get_key(self, method: str, arguments: Dict[str, Any], variant: Tuple) -> str:
+        normalized = json.dumps(
+            [method, normalize_arguments(method, arguments), list(variant)],
+            sort_keys=True,
+            default=str,
+        )
+        return (
+            KEY_PREFIX
+            + hashlib.blake2b(normalized.encode(), digest_size=16).hexdigest()
+        )
+
+    def lookup(
+        self,
+        method: str,
+        arguments: Dict[str, Any],
+        variant: Tuple,
+        ctx: Dict[str, Any],
+        deadline: Optional[float] = None,
+    ) -> Optional[CachedResponse]:
+        """Cached response, or None after noting in ctx where to store it"""
+        key = self.get_key(method, arguments, variant)
+        values = self.store.cache_get_many(
+            [scoring.INTERESTS_GENERATION_KEY, key], deadline=deadline
+        )
+        if values is None:
+            return None
+        generation, entry = int(values[0] or 0), values[1]
+        if entry:
+            entry_generation, encoding, data = entry.split(b"|", 2)
+            if int(entry_generation) == generation:
+                ctx["response_cache"] = "hit"
+                return CachedResponse(encoding.decode() or None, data)
+        ctx["response_cache"] = "miss"
+        # the generation read before the response is built: a write meanwhile
+        # makes the stored entry a miss right away
+        ctx["response_cache_entry"] = (key, generation)
+        return None
+
+    def store_response(
+        self, cache_entry: Tuple[str, int], encoding: Optional[str], data: bytes
+    ) -> None:
+        key, generation = cache_entry
+        entry = b"%d|%s|" % (generation, (encoding or "").encode()) + data
+        self.store.cache_set(key, entry, self.ttl)
@@ -1,55 +1,325 @@
+import datetime
 import hashlib
 import json
+import logging
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 
 from storage import Storage
 
+# scores are served as is for SCORE_SOFT_TTL seconds, then served stale
+# and refreshed in background until they expire after SCORE_HARD_TTL
+SCORE_SOFT_TTL = 60 * 60
+SCORE_HARD_TTL = 2 * 60 * 60
+
+# "binary" keys are the raw digest, "hex" keys are readable in redis-cli
+SCORE_KEY_FORMATS = ["binary", "hex"]
+SCORE_KEY_FORMAT = "binary"
+KEY_PREFIX = b"uid2:"
+
+# where a missed score is calculated: "client" - here, then cached with a
+# second call, "script" - by SCORE_SCRIPT in redis within the lookup call
+SCORE_LOOKUP_MODES = ["client", "script"]
+SCORE_LOOKUP = "client"
+
+# score of a person is the sum of weights of the fields they have
+PHONE_WEIGHT = 1.5
+EMAIL_WEIGHT = 1.5
+BIRTHDAY_GENDER_WEIGHT = 1.5
+NAME_WEIGHT = 0.5
+
+# KEYS[1] - score key, ARGV[1..4] - "1" for every present field of
+# phone, email, birthday and gender, first and last name, ARGV[5..8] - their
+# weights, ARGV[9] - fresh until, ARGV[10] - hard ttl.
+# Returns the cached value, or caches and returns the calculated one
+# encoded like encode_score.
+SCORE_SCRIPT = """
+local cached = redis.call('GET', KEYS[1])
+if cached then
+    return cached
+end
+local score = 0
+for i = 1, 4 do
+    if ARGV[i] == '1' then
+        score = score + tonumber(ARGV[i + 4])
+    end
+end
+score = tostring(score)
+if not string.find(score, '[.e]') then
+    score = score .. '.0'
+end
+local value = score .. '|' .. ARGV[9]
+redis.call('SET', KEYS[1], value, 'EX', ARGV[10])
+return value
+"""
+
+# interests history is kept for this many days, versions are day numbers
+INTERESTS_RETENTION_DAYS = 90
+
+# bumped on every interests change, cached responses of older ones are stale
+INTERESTS_GENERATION_KEY = "ig"
+# day of the latest interests change of every client with a history
+INTERESTS_INDEX_KEY = "ivx"
+
+# keys being refreshed right now, at most one refresh per key
+refreshing = set()
+refreshing_lock = threading.Lock()
+
+
+def normalize_name(value) -> str:
+    return " ".join(str(value).split()).casefold() if value else ""
+
 
 def get_key(
     phone,
     birthday=None,
     first_name=None,
     last_name=None,
-) -> str:
+    email=None,
+    gender=None,
+) -> Union[str, bytes]:
+    """Cache key of a person, covering every field the score depends on.
+
+    Values are normalized, so 79175002040 and "79175002040", or "Ivan" and
+    " ivan " give the same key. The "binary" format keeps the raw 16 byte
+    digest and takes about half the memory of "hex" per key.
+    """
     key_parts = [
-        first_name or "",
-        last_name or "",
-        phone or "",
+        normalize_name(first_name),
+        normalize_name(last_name),
+        str(phone).strip() if phone else "",
+        str(email).strip().lower() if email else "",
         birthday.strftime("%Y%m%d") if birthday is not None else "",
+        str(gender) if gender is not None else "",
     ]
-    return (
-        "uid:"
-        + hashlib.md5("".join([str(v) for v in key_parts]).encode("utf-8")).hexdigest()
-    )
+    digest = hashlib.blake2b(
+        "\x1f".join(key_parts).encode("utf-8"), digest_size=16
+    ).digest()
+    if SCORE_KEY_FORMAT == "binary":
+        return KEY_PREFIX + digest
+    return KEY_PREFIX.decode() + digest.hex()
 
 
-def get_score(
-    store: Storage,
+def encode_score(score: float, soft_ttl: int) -> str:
+    return f"{score}|{time.time() + soft_ttl}"
+
+
+def decode_score(value: bytes) -> Tuple[float, float]:
+    """Return the cached score and the time it stays fresh until"""
+    score, _, fresh_until = value.decode().partition("|")
+    # plain values cached before soft TTL was introduced never get stale
+    return float(score), float(fresh_until) if fresh_until else float("inf")
+
+
+def refresh_in_background(key: Union[str, bytes], refresh: Callable[[], None]) -> None:
+    with refreshing_lock:
+        if key in refreshing:
+            return
+        refreshing.add(key)
+
+    def run():
+        try:
+            refresh()
+        except Exception as e:
+            logging.info(f"Score refresh failed for {key}: {e}")
+        finally:
+            with refreshing_lock:
+                refreshing.discard(key)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def compute_score(
     phone,
     email,
     birthday=None,
     gender=None,
     first_name=None,
     last_name=None,
-):
-    key = get_key(phone, birthday, first_name, last_name)
-    # try get from cache,
-    # fallback to heavy calculation in case of cache miss
-    score = store.cache_get(key) or 0
-    if score:
-        return float(score)
+) -> float:
+    score = 0
     if phone:
-        score += 1.5
+        score += PHONE_WEIGHT
     if email:
-        score += 1.5
+        score += EMAIL_WEIGHT
     if birthday and gender:
-        score += 1.5
+        score += BIRTHDAY_GENDER_WEIGHT
     if first_name and last_name:
-        score += 0.5
-    # cache for 60 minutes
-    store.cache_set(key, score, 60 * 60)
+        score += NAME_WEIGHT
     return float(score)
 
 
-def get_interests(store: Storage, cid):
-    r = store.get("i:%s" % cid)
-    return json.loads(r) if r else []
+def score_script_args(
+    phone, email, birthday, gender, first_name, last_name, soft_ttl, hard_ttl
+) -> List[Any]:
+    present = [phone, email, birthday and gender, first_name and last_name]
+    weights = [PHONE_WEIGHT, EMAIL_WEIGHT, BIRTHDAY_GENDER_WEIGHT, NAME_WEIGHT]
+    return (
+        [1 if value else 0 for value in present]
+        + weights
+        + [time.time() + soft_ttl, hard_ttl]
+    )
+
+
+def get_score(
+    store: Storage,
+    phone,
+    email,
+    birthday=None,
+    gender=None,
+    first_name=None,
+    last_name=None,
+    soft_ttl: Optional[int] = None,
+    hard_ttl: Optional[int] = None,
+    deadline: Optional[float] = None,
+):
+    soft_ttl = soft_ttl or SCORE_SOFT_TTL
+    hard_ttl = max(hard_ttl or SCORE_HARD_TTL, soft_ttl)
+    key = get_key(phone, birthday, first_name, last_name, email, gender)
+
+    def calculate_and_cache(deadline: Optional[float] = None) -> float:
+        score = compute_score(phone, email, birthday, gender, first_name, last_name)
+        store.cache_set(key, encode_score(score, soft_ttl), hard_ttl, deadline=deadline)
+        return score
+
+    if SCORE_LOOKUP == "script":
+        # a miss is calculated and cached by redis within the same call
+        args = score_script_args(
+            phone, email, birthday, gender, first_name, last_name, soft_ttl, hard_ttl
+        )
+        cached = store.cache_eval(SCORE_SCRIPT, [key], args, deadline=deadline)
+    else:
+        # try get from cache,
+        # fallback to heavy calculation in case of cache miss
+        cached = store.cache_get(key, deadline=deadline)
+    if cached:
+        score, fresh_until = decode_score(cached)
+        if time.time() >= fresh_until:
+            refresh_in_background(key, calculate_and_cache)
+        return score
+    return calculate_and_cache(deadline)
+
+
+def get_scores(
+    store: Storage,
+    people: List[Dict[str, Any]],
+    soft_ttl: Optional[int] = None,
+    hard_ttl: Optional[int] = None,
+) -> List[float]:
+    """Batch get_score: one round trip to read and one to write the cache.
+
+    Each item holds get_score keyword arguments. Stale scores are
+    recalculated right away, nobody waits for a batch but its caller.
+    """
+    soft_ttl = soft_ttl or SCORE_SOFT_TTL
+    hard_ttl = max(hard_ttl or SCORE_HARD_TTL, soft_ttl)
+    keys = [
+        get_key(
+            person.get("phone"),
+            person.get("birthday"),
+            person.get("first_name"),
+            person.get("last_name"),
+            person.get("email"),
+            person.get("gender"),
+        )
+        for person in people
+    ]
+    cached = store.cache_get_many(keys) if keys else None
+    scores, to_cache = [], {}
+    for key, person, value in zip(keys, people, cached or [None] * len(keys)):
+        if value:
+            score, fresh_until = decode_score(value)
+            if time.time() < fresh_until:
+                scores.append(score)
+                continue
+        score = compute_score(**person)
+        to_cache[key] = encode_score(score, soft_ttl)
+        scores.append(score)
+    if to_cache:
+        store.cache_set_many(to_cache, hard_ttl)
+    return scores
+
+
+def get_interests(store: Storage, cid, deadline: Optional[float] = None):
+    interests_filter = getattr(store, "interests_filter", None)
+    # definitely no record, don't go to storage for it
+    if interests_filter is not None and cid not in interests_filter:
+        return []
+    r = store.get("i:%s" % cid, deadline=deadline)
+    # str() decodes bytes and memoryviews of the mapped snapshot alike
+    return json.loads(str(r, "utf-8")) if r else []
+
+
+def get_interests_as_of(
+    store: Storage, cids: List[Any], date: datetime.date, deadline=None
+) -> Dict[Any, List[Any]]:
+    """Interests of every client as they were on the date.
+
+    `i:<cid>` always has the latest interests, so today and later dates are
+    read from it alone. Clients without history (written before versioning,
+    or unchanged for longer than the retention) get their current interests
+    as well.
+    """
+    interests_filter = getattr(store, "interests_filter", None)
+    result = {cid: [] for cid in cids}
+    lookup = [
+        cid for cid in result if interests_filter is None or cid in interests_filter
+    ]
+    if not lookup:
+        return result
+    keys = ["i:%s" % cid for cid in lookup]
+    if date >= datetime.date.today():
+        values = store.get_many(keys, deadline=deadline)
+    else:
+        values = store.get_versions(
+            ["iv:%s" % cid for cid in lookup],
+            keys,
+            date.toordinal(),
+            index_key=INTERESTS_INDEX_KEY,
+            deadline=deadline,
+        )
+    for cid, value in zip(lookup, values):
+        result[cid] = json.loads(value) if value else []
+    return result
+
+
+def set_interests(
+    store: Storage, cid, interests: List[Any], date: Optional[datetime.date] = None
+) -> None:
+    """Set interests of a client since the date, today by default.
+
+    `i:<cid>` is updated too unless a later change is already recorded.
+    """
+    generation = write_interests(store, {cid: json.dumps(interests)}, date)
+    if store.interests_filter is not None:
+        store.interests_filter.add(cid, generation)
+
+
+def write_interests(
+    store: Storage,
+    encoded: Dict[Any, str],
+    date: Optional[datetime.date] = None,
+    bump_generation: bool = True,
+) -> Optional[int]:
+    """Record json encoded interests of many clients since the date at once.
+
+    The interests generation is bumped in the same transaction when any of
+    them changed; returns the new generation, None if it wasn't bumped.
+    """
+    today = datetime.date.today()
+    date = date or today
+    _, generation = store.set_versions(
+        {"iv:%s" % cid: value for cid, value in encoded.items()},
+        date.toordinal(),
+        keep_since=today.toordinal() - INTERESTS_RETENTION_DAYS,
+        seconds=INTERESTS_RETENTION_DAYS * 24 * 60 * 60,
+        latest_keys={"iv:%s" % cid: "i:%s" % cid for cid in encoded},
+        incr_key=INTERESTS_GENERATION_KEY if bump_generation else None,
+        index_key=INTERESTS_INDEX_KEY,
+    )
+    return generation
+
+
+def bump_interests_generation(store: Storage) -> int:
+    return store.incr(INTERESTS_GENERATION_KEY)
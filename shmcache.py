@@ -0,0 +1,98 @@
+"""Fixed size hash table in shared memory, shared by pre-forked workers.
+
+Every slot is guarded by a sequence counter (seqlock): a writer makes it odd
+while the slot is being changed and even again after, a reader copies the
+slot and retries when the counter was odd or changed meanwhile. Writers of
+the same slot are serialized with a lock stripe, readers never lock.
+
+Slot layout: seq | key digest | expires at | value length | value
+"""
+
+import hashlib
+import multiprocessing
+import struct
+import time
+from multiprocessing import shared_memory
+from typing import Optional, Union
+
+SEQ = struct.Struct("<I")
+ENTRY = struct.Struct("<16sdH")
+PROBES = 4
+READ_RETRIES = 8
+
+
+class SharedCache:
+    def __init__(self, slots: int = 65536, value_size: int = 64, stripes: int = 64):
+        self.slots = slots
+        self.value_size = value_size
+        # 8 byte aligned slots keep sequence counter writes from tearing
+        self.slot_size = (SEQ.size + ENTRY.size + value_size + 7) // 8 * 8
+        self.shm = shared_memory.SharedMemory(create=True, size=slots * self.slot_size)
+        self.shm.buf[:] = bytes(len(self.shm.buf))
+        # locks have to exist before workers are forked to be shared with them
+        self.locks = [multiprocessing.Lock() for _ in range(stripes)]
+
+    @staticmethod
+    def digest(key: Union[str, bytes]) -> bytes:
+        if isinstance(key, str):
+            key = key.encode("utf-8")
+        return hashlib.blake2b(key, digest_size=16).digest()
+
+    def positions(self, digest: bytes):
+        start = int.from_bytes(digest[:8], "little") % self.slots
+        return [(start + i) % self.slots * self.slot_size for i in range(PROBES)]
+
+    def read_slot(self, offset: int) -> Optional[tuple]:
+        buf = self.shm.buf
+        for _ in range(READ_RETRIES):
+            (seq,) = SEQ.unpack_from(buf, offset)
+            if seq & 1:
+                continue
+            digest, expires, length = ENTRY.unpack_from(buf, offset + SEQ.size)
+            start = offset + SEQ.size + ENTRY.size
+            value = bytes(buf[start : start + min(length, self.value_size)])
+            if SEQ.unpack_from(buf, offset)[0] == seq:
+                return digest, expires, value
+        # a writer keeps the slot busy, a cache may just miss
+        return None
+
+    def get(self, key: Union[str, bytes]) -> Optional[bytes]:
+        digest = self.digest(key)
+        now = time.time()
+        for offset in self.positions(digest):
+            slot = self.read_slot(offset)
+            if slot is not None and slot[0] == digest and slot[1] > now:
+                return slot[2]
+        return None
+
+    def set(self, key: Union[str, bytes], value: bytes, ttl: float) -> bool:
+        if len(value) > self.value_size:
+            return False
+        digest = self.digest(key)
+        positions = self.positions(digest)
+        now = time.time()
+        slots = [(offset, self.read_slot(offset)) for offset in positions]
+        # the slot of the same key wherever it is among the probes, so that
+        # no stale copy is left behind; a busy slot may be that key as well
+        same = [offset for offset, slot in slots if slot and slot[0] == digest]
+        busy = [offset for offset, slot in slots if slot is None]
+        if same or busy:
+            target = (same or busy)[0]
+        else:
+            # a free or expired slot, else the one expiring first
+            target = min(slots, key=lambda item: max(item[1][1], now))[0]
+        buf = self.shm.buf
+        with self.locks[target // self.slot_size % len(self.locks)]:
+            (seq,) = SEQ.unpack_from(buf, target)
+            SEQ.pack_into(buf, target, seq + 1)
+            ENTRY.pack_into(buf, target + SEQ.size, digest, now + ttl, len(value))
+            start = target + SEQ.size + ENTRY.size
+            buf[start : start + len(value)] = value
+            SEQ.pack_into(buf, target, (seq + 2) & 0xFFFFFFFF)
+        return True
+
+    def close(self) -> None:
+        self.shm.close()
+
+    def unlink(self) -> None:
+        self.shm.unlink()
@@ -1,16 +1,80 @@
 import functools
 import logging
+import threading
 import time
-from typing import Any, Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import redis
 
+# sorted set members of versioned values are `<version>|<value>`
+VERSION_SEPARATOR = "|"
+
+
+class DeadlineExceeded(Exception):
+    """Request time budget is spent before storage answered"""
+
+
+def remaining(deadline: Optional[float]) -> float:
+    """Seconds left until monotonic deadline, infinity without deadline"""
+    return float("inf") if deadline is None else deadline - time.monotonic()
+
+
+# deadline of the storage call running in the thread, see DeadlineConnection
+_call = threading.local()
+# a spent deadline still gives redis a moment instead of a non-blocking socket
+MIN_SOCKET_TIMEOUT = 0.001
+
+
+class DeadlineConnection(redis.Connection):
+    """Connection which waits for redis no longer than the call deadline.
+
+    Socket timeouts are set once per connection, so without this a call
+    made with a second of budget left could block for the whole
+    socket_timeout on a stalled server.
+    """
+
+    def call_timeout(self, timeout: Optional[float]) -> Optional[float]:
+        deadline = getattr(_call, "deadline", None)
+        if deadline is None:
+            return timeout
+        left = max(remaining(deadline), MIN_SOCKET_TIMEOUT)
+        return left if timeout is None else min(timeout, left)
+
+    def connect(self) -> None:
+        configured = self.socket_connect_timeout
+        self.socket_connect_timeout = self.call_timeout(configured)
+        try:
+            super().connect()
+        finally:
+            self.socket_connect_timeout = configured
+
+    def read_response(self) -> Any:
+        timeout = self.call_timeout(self.socket_timeout)
+        if self._sock is None or timeout == self.socket_timeout:
+            return super().read_response()
+        self._sock.settimeout(timeout)
+        try:
+            return super().read_response()
+        finally:
+            # the socket is gone if the read timed out
+            if self._sock is not None:
+                self._sock.settimeout(self.socket_timeout)
+
 
 def retry(use_cache: bool = False):
     def retry_decorator(method):
-        @functools.wraps(method)
-        def retry_method(self, *args, **kwargs):
+        def call_method(self, *args, deadline=None, **kwargs):
+            previous, _call.deadline = getattr(_call, "deadline", None), deadline
+            try:
+                return call_with_deadline(self, *args, deadline=deadline, **kwargs)
+            finally:
+                _call.deadline = previous
+
+        def call_with_deadline(self, *args, deadline=None, **kwargs):
             if use_cache:
+                # nobody waits for the result anymore, don't bother the cache
+                if remaining(deadline) <= 0:
+                    return None
                 try:
                     return method(self, *args, **kwargs)
                 except Exception as e:
@@ -19,17 +83,31 @@ def retry(use_cache: bool = False):
             cnt = 1
             retries = self.RETRY_NUMBER
             while cnt <= retries:
+                if remaining(deadline) <= 0:
+                    raise DeadlineExceeded(f"{method.__name__} deadline exceeded")
                 try:
                     return method(self, *args, **kwargs)
+                except redis.exceptions.TimeoutError:
+                    if remaining(deadline) <= 0:
+                        raise DeadlineExceeded(f"{method.__name__} deadline exceeded")
+                    raise
                 except redis.exceptions.ConnectionError as e:
                     base_msg = f"Redis server is not available: {e}."
                     if cnt > 1:
                         base_msg += f"\n Attempt {cnt} out of {retries}"
                     logging.info(base_msg)
                     cnt += 1
-                    time.sleep(1)
+                    time.sleep(max(0, min(1, remaining(deadline))))
             raise redis.exceptions.ConnectionError
 
+        @functools.wraps(method)
+        def retry_method(self, *args, **kwargs):
+            start = time.monotonic()
+            try:
+                return call_method(self, *args, **kwargs)
+            finally:
+                self.record_call(method.__name__, time.monotonic() - start)
+
         return retry_method
 
     return retry_decorator
@@ -37,23 +115,268 @@ def retry(use_cache: bool = False):
 
 class Storage:
     RETRY_NUMBER = 5
+    # optional bloom filter of client ids having interests, see bloom.py
+    interests_filter = None
+    # optional cache shared by the workers of a host, see shmcache.py
+    local_cache = None
+    LOCAL_CACHE_TTL = 60
 
     def __init__(self, socket_timeout: int, socket_connect_timeout: int):
         self.client = redis.Redis(
-            socket_timeout=socket_timeout, socket_connect_timeout=socket_connect_timeout
+            connection_pool=redis.ConnectionPool(
+                connection_class=DeadlineConnection,
+                socket_timeout=socket_timeout,
+                socket_connect_timeout=socket_connect_timeout,
+            )
         )
+        # per-thread call stats, so that concurrent requests don't mix up
+        self._stats = threading.local()
+        # lua source -> registered script, see cache_eval
+        self._scripts = {}
+
+    def reset_stats(self) -> None:
+        self._stats.calls = {}
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Count and total duration (ms) of storage calls since the last reset"""
+        return getattr(self._stats, "calls", {})
+
+    def record_call(self, name: str, elapsed: float) -> None:
+        calls = getattr(self._stats, "calls", None)
+        if calls is None:
+            calls = self._stats.calls = {}
+        stat = calls.setdefault(name, {"count": 0, "ms": 0.0})
+        stat["count"] += 1
+        stat["ms"] = round(stat["ms"] + elapsed * 1000, 3)
 
     def health_check(self) -> bool:
         return self.client.ping()
 
     @retry(use_cache=True)
     def cache_set(self, key: str, value: Any, seconds: int) -> bool:
+        if self.local_cache is not None:
+            data = value if isinstance(value, bytes) else str(value).encode()
+            self.local_cache.set(key, data, min(seconds, self.LOCAL_CACHE_TTL))
         return self.client.set(key, value, ex=seconds)
 
+    @retry(use_cache=False)
+    def set(self, key: str, value: Any) -> bool:
+        return self.client.set(key, value)
+
+    @retry(use_cache=False)
+    def set_many(self, mapping: Dict[str, Any]) -> bool:
+        return self.client.mset(mapping)
+
     @retry(use_cache=False)
     def get(self, key: str) -> Any:
         return self.client.get(key)
 
+    @retry(use_cache=False)
+    def incr(self, key: str) -> int:
+        return self.client.incr(key)
+
+    @retry(use_cache=False)
+    def get_many(self, keys: List[str]) -> List[Any]:
+        return self.client.mget(keys)
+
     @retry(use_cache=True)
     def cache_get(self, key: str) -> Optional[Any]:
-        return self.client.get(key)
+        if self.local_cache is not None:
+            value = self.local_cache.get(key)
+            if value is not None:
+                return value
+        value = self.client.get(key)
+        if value is not None and self.local_cache is not None:
+            self.local_cache.set(key, value, self.LOCAL_CACHE_TTL)
+        return value
+
+    @retry(use_cache=True)
+    def cache_get_many(self, keys: List[str]) -> Optional[List[Any]]:
+        return self.client.mget(keys)
+
+    @retry(use_cache=True)
+    def cache_eval(self, script: str, keys: List[Any], args: List[Any]) -> Any:
+        """Run a lua script by its sha (EVALSHA).
+
+        redis-py loads the script again when the server answers NOSCRIPT,
+        e.g. after a restart or SCRIPT FLUSH.
+        """
+        registered = self._scripts.get(script)
+        if registered is None:
+            registered = self._scripts[script] = self.client.register_script(script)
+        return registered(keys=keys, args=args)
+
+    @retry(use_cache=True)
+    def cache_set_many(self, mapping: Dict[str, Any], seconds: int) -> bool:
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in mapping.items():
+            pipe.set(key, value, ex=seconds)
+        return all(pipe.execute())
+
+    @retry(use_cache=False)
+    def set_version(
+        self,
+        key: str,
+        value: str,
+        version: int,
+        keep_since: int,
+        seconds: int,
+        latest_key: Optional[str] = None,
+    ) -> bool:
+        """Store value as of version (e.g. a day number) in sorted set `key`.
+
+        Nothing is written when the version in effect already has the value,
+        so the set grows with changes only. Versions replaced before
+        keep_since are dropped, the set expires `seconds` after the last change.
+
+        latest_key, if given, holds the value of the latest version: it is
+        set unless a later version exists, and a new set starts with its
+        previous value (empty if missing) at version 0, so that a lookup of
+        a set never falls back to a value newer than the versions.
+        """
+        latest_keys = {key: latest_key} if latest_key else None
+        changed, _ = self.write_versions(
+            {key: value}, version, keep_since, seconds, latest_keys
+        )
+        return changed > 0
+
+    @retry(use_cache=False)
+    def set_versions(
+        self,
+        values: Dict[str, str],
+        version: int,
+        keep_since: int,
+        seconds: int,
+        latest_keys: Optional[Dict[str, str]] = None,
+        incr_key: Optional[str] = None,
+        index_key: Optional[str] = None,
+    ) -> Tuple[int, Optional[int]]:
+        """set_version for many sorted sets in one transaction.
+
+        incr_key, if given, is incremented in the same transaction when any
+        set changes. Returns the number of sets changed and the new incr_key
+        value, None if it wasn't incremented.
+
+        index_key, if given, is a hash of the latest version of every set,
+        so that get_versions can answer the versions from then on with the
+        latest keys, without looking the sets up.
+        """
+        return self.write_versions(
+            values, version, keep_since, seconds, latest_keys, incr_key, index_key
+        )
+
+    def write_versions(
+        self,
+        values: Dict[str, str],
+        version: int,
+        keep_since: int,
+        seconds: int,
+        latest_keys: Optional[Dict[str, str]],
+        incr_key: Optional[str] = None,
+        index_key: Optional[str] = None,
+    ) -> Tuple[int, Optional[int]]:
+        latest_keys = latest_keys or {}
+        watched = list(values) + list(latest_keys.values())
+        with self.client.pipeline(transaction=True) as pipe:
+            while True:
+                # the checks below are redone if another writer changes any
+                # of the keys before the transaction runs
+                pipe.watch(*watched)
+                reads = self.read_versions(
+                    list(values), version, keep_since, latest_keys
+                )
+                pipe.multi()
+                changed = 0
+                for key, value in values.items():
+                    current, kept, later, exists, latest = reads[key]
+                    if current and self.version_value(current[0]) == value:
+                        continue
+                    changed += 1
+                    latest_key = latest_keys.get(key)
+                    if latest_key and not exists and version > 0:
+                        initial = latest.decode("utf-8") if latest else ""
+                        pipe.zadd(key, {f"0{VERSION_SEPARATOR}{initial}": 0})
+                    pipe.zremrangebyscore(key, version, version)
+                    pipe.zadd(key, {f"{version}{VERSION_SEPARATOR}{value}": version})
+                    if kept and kept[0][1] < version:
+                        pipe.zremrangebyscore(key, "-inf", f"({kept[0][1]}")
+                    pipe.expire(key, seconds)
+                    if latest_key and not later:
+                        pipe.set(latest_key, value)
+                        if index_key:
+                            pipe.hset(index_key, key, version)
+                if changed and incr_key:
+                    pipe.incr(incr_key)
+                try:
+                    results = pipe.execute()
+                except redis.exceptions.WatchError:
+                    continue
+                return changed, results[-1] if changed and incr_key else None
+
+    def read_versions(
+        self,
+        keys: List[str],
+        version: int,
+        keep_since: int,
+        latest_keys: Dict[str, str],
+    ) -> Dict[str, List[Any]]:
+        """What write_versions needs to know of every set, in one round trip"""
+        pipe = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipe.zrevrangebyscore(key, version, "-inf", start=0, num=1)
+            pipe.zrevrangebyscore(
+                key, keep_since, "-inf", start=0, num=1, withscores=True
+            )
+            pipe.zrangebyscore(key, f"({version}", "+inf", start=0, num=1)
+            pipe.exists(key)
+            if key in latest_keys:
+                pipe.get(latest_keys[key])
+        results = iter(pipe.execute())
+        reads = {}
+        for key in keys:
+            reads[key] = [next(results) for _ in range(4)]
+            reads[key].append(next(results) if key in latest_keys else None)
+        return reads
+
+    @retry(use_cache=False)
+    def get_versions(
+        self,
+        keys: List[str],
+        fallback_keys: List[str],
+        version: int,
+        index_key: Optional[str] = None,
+    ) -> List[Any]:
+        """Values in effect at version for every sorted set.
+
+        Keys without a version up to `version` are answered with their
+        fallback key value. With index_key (see set_versions), so are the
+        sets whose latest version is up to `version`, and only the others
+        are looked up, in a second round trip.
+        """
+        pipe = self.client.pipeline(transaction=False)
+        pipe.mget(fallback_keys)
+        if index_key:
+            pipe.hmget(index_key, keys)
+        values, *index = pipe.execute()
+        if index:
+            lookup = [
+                pos
+                for pos, latest in enumerate(index[0])
+                if latest is not None and int(latest) > version
+            ]
+        else:
+            lookup = list(range(len(keys)))
+        if lookup:
+            pipe = self.client.pipeline(transaction=False)
+            for pos in lookup:
+                pipe.zrevrangebyscore(keys[pos], version, "-inf", start=0, num=1)
+            for pos, found in zip(lookup, pipe.execute()):
+                if found:
+                    values[pos] = self.version_value(found[0])
+        return values
+
+    @staticmethod
+    def version_value(member: Union[str, bytes]) -> str:
+        if isinstance(member, bytes):
+            member = member.decode("utf-8")
+        return member.split(VERSION_SEPARATOR, 1)[1]
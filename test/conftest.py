@@ -1,10 +1,13 @@
 import json
 import random
+import threading
+from http.server import HTTPServer
 from typing import List
 
 import fakeredis
 import pytest
 
+import api
 from storage import Storage
 
 
@@ -21,9 +24,9 @@ def storage():
 
 def insert_interests_data(storage: Storage, cid_list: List[int]):
     interests = ["books", "music", "cinema", "sport"]
-    for cid in cid_list:
-        key = "i:%s" % cid
-        storage.client.set(key, json.dumps(random.sample(interests, 2)))
+    storage.set_many(
+        {"i:%s" % cid: json.dumps(random.sample(interests, 2)) for cid in cid_list}
+    )
 
 
 @pytest.fixture(scope="session")
@@ -39,3 +42,14 @@ def disconnected_storage():
 @pytest.fixture(scope="function")
 def storage_object():
     return {"key": "value"}
+
+
+@pytest.fixture(scope="function")
+def http_server(storage):
+    handler = type("TestHTTPHandler", (api.MainHTTPHandler,), {"store": storage})
+    server = HTTPServer(("localhost", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -1,9 +1,15 @@
 import datetime
 import hashlib
+import time
+import tracemalloc
 
 import pytest
 
 import api
+import interests_store
+import memwatch
+import ratelimit
+import scoring
 
 
 def set_valid_auth(request):
@@ -225,3 +231,214 @@ def test_ok_interests_request(arguments, storage):
         for v in response.values()
     )
     assert ctx.get("nclients") == len(arguments["client_ids"])
+
+
+def test_rate_limited_request(storage):
+    req = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "online_score",
+        "arguments": {"first_name": "a", "last_name": "b"},
+    }
+    set_valid_auth(req)
+    limiter = ratelimit.LocalRateLimiter(rate=0.001, burst=1)
+    request = {"body": req, "headers": {}}
+    _, code, _ = api.method_handler(request, {}, storage, limiter=limiter)
+    assert api.OK == code
+    _, code, _ = api.method_handler(request, {}, storage, limiter=limiter)
+    assert api.TOO_MANY_REQUESTS == code
+
+
+def test_interests_request_from_snapshot(storage, tmp_path):
+    path = str(tmp_path / "interests.db")
+    interests_store.build_snapshot([(1, b'["travel"]')], path)
+    req = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "clients_interests",
+        "arguments": {"client_ids": [1, 2]},
+    }
+    set_valid_auth(req)
+    response, code, _ = api.method_handler(
+        {"body": req, "headers": {}},
+        {},
+        storage,
+        interests_store=interests_store.MmapInterestsStore(path),
+    )
+    assert api.OK == code
+    assert response == {1: ["travel"], 2: []}
+
+
+@pytest.mark.parametrize("login, expected", [("admin", api.OK), ("h&f", api.FORBIDDEN)])
+def test_memory_stats_request(login, expected, storage):
+    req = {
+        "account": "horns&hoofs",
+        "login": login,
+        "method": "memory_stats",
+        "arguments": {},
+    }
+    set_valid_auth(req)
+    try:
+        response, code, _ = api.method_handler(
+            {"body": req, "headers": {}}, {}, storage
+        )
+    finally:
+        memwatch.watcher.stop()
+    assert expected == code
+    if code == api.OK:
+        assert response["rss"] > 0
+        # tracing stays off unless asked for
+        assert "top" not in response
+        assert not tracemalloc.is_tracing()
+
+
+@pytest.mark.parametrize(
+    "tracing, expected", [(True, api.OK), (False, api.OK), ("yes", api.INVALID_REQUEST)]
+)
+def test_memory_stats_request_switches_tracing(tracing, expected, storage):
+    req = {
+        "account": "horns&hoofs",
+        "login": "admin",
+        "method": "memory_stats",
+        "arguments": {"tracemalloc": tracing},
+    }
+    set_valid_auth(req)
+    try:
+        response, code, _ = api.method_handler(
+            {"body": req, "headers": {}}, {}, storage
+        )
+        assert expected == code
+        assert tracemalloc.is_tracing() == (tracing is True)
+        if code == api.OK:
+            assert ("top" in response) == (tracing is True)
+    finally:
+        memwatch.watcher.stop()
+
+
+@pytest.mark.parametrize(
+    "method, arguments",
+    [
+        ("online_score", {"first_name": "a", "last_name": "b"}),
+        ("clients_interests", {"client_ids": [1, 2]}),
+    ],
+)
+def test_request_deadline_exceeded(method, arguments, disconnected_storage):
+    req = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": method,
+        "arguments": arguments,
+    }
+    set_valid_auth(req)
+    response, code, _ = api.method_handler(
+        {"body": req, "headers": {}},
+        {},
+        disconnected_storage,
+        deadline=time.monotonic() - 1,
+    )
+    if method == "online_score":
+        # the score cache is skipped, the score is still calculated
+        assert api.OK == code
+    else:
+        assert api.GATEWAY_TIMEOUT == code
+        assert "timeout" in response
+
+
+@pytest.mark.parametrize(
+    "client_ids, heavy_lane_ids, lane",
+    [
+        ([1, 2], api.DEFAULT_HEAVY_LANE_IDS, "clients_interests"),
+        (list(range(1, 200)), api.DEFAULT_HEAVY_LANE_IDS, api.HEAVY_LANE),
+        ([1, 2], 1, api.HEAVY_LANE),
+    ],
+)
+def test_interests_request_lane(client_ids, heavy_lane_ids, lane, storage):
+    req = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "clients_interests",
+        "arguments": {"client_ids": client_ids},
+    }
+    set_valid_auth(req)
+    lanes = {
+        name: ratelimit.Lane(name, workers=1)
+        for name in ("online_score", "clients_interests", api.HEAVY_LANE)
+    }
+    ctx = {}
+    _, code, ctx = api.method_handler(
+        {"body": req, "headers": {}},
+        ctx,
+        storage,
+        lanes=lanes,
+        heavy_lane_ids=heavy_lane_ids,
+    )
+    assert api.OK == code
+    assert ctx["lane"] == lane
+    assert "queue" in ctx["timings"]
+    assert lanes[lane].stats()["completed"] == 1
+
+
+@pytest.mark.parametrize(
+    "deadline, expected",
+    [(None, api.SERVICE_UNAVAILABLE), (-1, api.GATEWAY_TIMEOUT)],
+)
+def test_request_lane_full(deadline, expected, storage):
+    req = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "online_score",
+        "arguments": {"first_name": "a", "last_name": "b"},
+    }
+    set_valid_auth(req)
+    # without a deadline the request has no queue to wait in
+    queue_size = 0 if deadline is None else 1
+    lane = ratelimit.Lane("online_score", workers=1, queue_size=queue_size)
+    # the only worker is busy
+    assert lane.acquire() == 0
+    if deadline is not None:
+        deadline += time.monotonic()
+    _, code, _ = api.method_handler(
+        {"body": req, "headers": {}},
+        {},
+        storage,
+        deadline=deadline,
+        lanes={"online_score": lane},
+    )
+    assert expected == code
+
+
+def test_lane_stats_request(storage):
+    req = {
+        "account": "horns&hoofs",
+        "login": "admin",
+        "method": "lane_stats",
+        "arguments": {},
+    }
+    set_valid_auth(req)
+    lanes = {"online_score": ratelimit.Lane("online_score", 4, 8)}
+    response, code, _ = api.method_handler(
+        {"body": req, "headers": {}}, {}, storage, lanes=lanes
+    )
+    assert api.OK == code
+    assert response["online_score"]["workers"] == 4
+    assert response["online_score"]["queue_size"] == 8
+
+
+def test_interests_request_as_of_date(storage):
+    today = datetime.date.today()
+    scoring.set_interests(storage, 300, ["hi-tech"], today - datetime.timedelta(days=3))
+    scoring.set_interests(storage, 300, ["pets"], today)
+    req = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "clients_interests",
+        "arguments": {
+            "client_ids": [300, 1],
+            "date": (today - datetime.timedelta(days=1)).strftime("%d.%m.%Y"),
+        },
+    }
+    set_valid_auth(req)
+    response, code, _ = api.method_handler({"body": req, "headers": {}}, {}, storage)
+    assert api.OK == code
+    assert response[300] == ["hi-tech"]
+    assert len(response[1]) == 2
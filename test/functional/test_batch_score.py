@@ -0,0 +1,67 @@
+import io
+import json
+
+import fakeredis
+import pytest
+
+import batch_score
+from storage import Storage
+
+LINES = [
+    {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+    {"first_name": "a", "last_name": "b"},
+    {"phone": "79175002040"},
+    {"gender": 1, "birthday": "01.01.2000", "first_name": "a", "last_name": "b"},
+]
+EXPECTED = [
+    {"score": 3.0},
+    {"score": 0.5},
+    {"code": 422},
+    {"score": 2.0},
+]
+
+
+def fake_storage():
+    s = Storage(socket_timeout=1, socket_connect_timeout=1)
+    s.client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    return s
+
+
+def run(lines, **kwargs):
+    source = io.StringIO("".join(line + "\n" for line in lines))
+    target = io.StringIO()
+    total = batch_score.score_file(
+        source, target, storage_factory=fake_storage, **kwargs
+    )
+    return total, [json.loads(line) for line in target.getvalue().splitlines()]
+
+
+def check(results, expected):
+    assert len(results) == len(expected)
+    for result, want in zip(results, expected):
+        assert want.items() <= result.items()
+
+
+@pytest.mark.parametrize("workers, chunk_size", [(0, 1000), (1, 3), (2, 1)])
+def test_score_file_keeps_order(workers, chunk_size):
+    lines = [json.dumps(line) for line in LINES * 5]
+    total, results = run(lines, workers=workers, chunk_size=chunk_size)
+    assert total == len(lines)
+    check(results, EXPECTED * 5)
+
+
+def test_score_file_invalid_lines():
+    total, results = run(["{not json", "[1, 2]", json.dumps(LINES[0])])
+    assert total == 3
+    check(results, [{"code": 400}, {"code": 422}, {"score": 3.0}])
+
+
+def test_score_chunk_uses_cache(mocker):
+    batch_score.init_worker(fake_storage)
+    lines = [json.dumps(LINES[0])] * 3
+    batch_score.score_chunk(lines)
+    cache_get_many = mocker.spy(batch_score.store, "cache_get_many")
+    cache_set_many = mocker.spy(batch_score.store, "cache_set_many")
+    assert batch_score.score_chunk(lines) == ['{"score": 3.0}'] * 3
+    cache_get_many.assert_called_once()
+    cache_set_many.assert_not_called()
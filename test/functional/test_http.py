@@ -0,0 +1,237 @@
+import gzip
+import http.client
+import json
+import logging
+
+import pytest
+
+import api
+import scoring
+from response_cache import ResponseCache
+
+from .test_api import set_valid_auth
+
+
+def post(server, body, headers=None):
+    conn = http.client.HTTPConnection(*server.server_address)
+    conn.request("POST", "/method", body=body, headers=headers or {})
+    response = conn.getresponse()
+    data = response.read()
+    conn.close()
+    return response, data
+
+
+@pytest.fixture
+def score_request():
+    req = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "online_score",
+        "arguments": {"phone": "79175002040", "email": "stupnikov@otus.ru"},
+    }
+    set_valid_auth(req)
+    return req
+
+
+def test_server_timing_header(http_server, score_request):
+    response, data = post(http_server, json.dumps(score_request))
+    assert response.status == 200
+    assert json.loads(data)["code"] == 200
+    stages = [m.split(";")[0] for m in response.getheader("Server-Timing").split(", ")]
+    for stage in ("read", "decode", "validate", "auth", "handler", "encode"):
+        assert stage in stages
+    assert "storage_cache_get" in stages
+
+
+def test_request_id_header_is_logged(http_server, score_request, caplog):
+    caplog.set_level(logging.INFO)
+    post(http_server, json.dumps(score_request), {"X-Request-Id": "req-42"})
+    contexts = [r.msg for r in caplog.records if isinstance(r.msg, dict)]
+    assert contexts[-1]["request_id"] == "req-42"
+    assert contexts[-1]["storage"]["cache_get"]["count"] == 1
+    assert "handler" in contexts[-1]["timings"]
+
+
+def test_bad_request_timings(http_server):
+    response, data = post(http_server, b"{not json")
+    assert response.status == 400
+    assert "decode" in response.getheader("Server-Timing")
+
+
+def test_load_shedding(http_server, score_request, mocker):
+    shedder = http_server.RequestHandlerClass.load_shedder
+    mocker.patch.object(shedder, "acquire", return_value=False)
+    response, data = post(http_server, json.dumps(score_request))
+    assert response.status == 503
+    assert response.getheader("Retry-After") == "1"
+    assert json.loads(data) == {"error": "Service Unavailable", "code": 503}
+
+
+def test_msgpack_request_and_response(http_server, score_request):
+    msgpack = pytest.importorskip("msgpack")
+    response, data = post(
+        http_server,
+        msgpack.packb(score_request),
+        {"Content-Type": "application/msgpack", "Accept": "application/msgpack"},
+    )
+    assert response.status == 200
+    assert response.getheader("Content-Type") == "application/msgpack"
+    assert msgpack.unpackb(data) == {"response": {"score": 3.0}, "code": 200}
+
+
+@pytest.mark.parametrize(
+    "accept, expected",
+    [
+        (None, "application/json"),
+        ("*/*", "application/json"),
+        ("application/json, application/msgpack", "application/json"),
+        ("application/x-msgpack;q=0.9, application/json", "application/msgpack"),
+    ],
+)
+def test_response_type_negotiation(http_server, score_request, accept, expected):
+    pytest.importorskip("msgpack")
+    headers = {"Accept": accept} if accept else {}
+    response, _ = post(http_server, json.dumps(score_request), headers)
+    assert response.getheader("Content-Type") == expected
+
+
+def test_msgpack_error_envelope(http_server):
+    msgpack = pytest.importorskip("msgpack")
+    response, data = post(
+        http_server,
+        msgpack.packb({"login": "h&f"}),
+        {"Content-Type": "application/msgpack", "Accept": "application/msgpack"},
+    )
+    assert response.status == 422
+    assert msgpack.unpackb(data)["code"] == 422
+
+
+def test_msgpack_not_installed(http_server, score_request, mocker):
+    mocker.patch.dict("api.CODECS", clear=True)
+    mocker.patch.dict("api.CODECS", {"application/json": (json.loads, api.json_dumps)})
+    response, data = post(http_server, b"\x80", {"Content-Type": "application/msgpack"})
+    assert response.status == 415
+    assert json.loads(data)["code"] == 415
+
+
+@pytest.fixture
+def interests_request():
+    req = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "clients_interests",
+        "arguments": {"client_ids": list(range(1000))},
+    }
+    set_valid_auth(req)
+    return req
+
+
+def test_gzip_large_response(http_server, interests_request, mocker):
+    mocker.patch.dict("api.COMPRESSORS", {"gzip": api.COMPRESSORS["gzip"]}, clear=True)
+    response, data = post(
+        http_server, json.dumps(interests_request), {"Accept-Encoding": "gzip"}
+    )
+    assert response.status == 200
+    assert response.getheader("Content-Encoding") == "gzip"
+    assert response.getheader("Vary") == "Accept-Encoding"
+    assert "compress;dur=" in response.getheader("Server-Timing")
+    assert len(json.loads(gzip.decompress(data))["response"]) == 1000
+
+
+def test_zstd_large_response(http_server, interests_request):
+    zstandard = pytest.importorskip("zstandard")
+    response, data = post(
+        http_server, json.dumps(interests_request), {"Accept-Encoding": "gzip, zstd"}
+    )
+    assert response.getheader("Content-Encoding") == "zstd"
+    decompressed = zstandard.ZstdDecompressor().decompress(data)
+    assert len(json.loads(decompressed)["response"]) == 1000
+
+
+@pytest.mark.parametrize("accept_encoding", [None, "identity", "gzip;q=0, br"])
+def test_uncompressed_large_response(http_server, interests_request, accept_encoding):
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+    response, data = post(http_server, json.dumps(interests_request), headers)
+    assert response.getheader("Content-Encoding") is None
+    assert len(json.loads(data)["response"]) == 1000
+
+
+def test_small_response_is_not_compressed(http_server, score_request):
+    response, data = post(
+        http_server, json.dumps(score_request), {"Accept-Encoding": "gzip, zstd"}
+    )
+    assert response.getheader("Content-Encoding") is None
+    assert json.loads(data)["code"] == 200
+
+
+@pytest.mark.parametrize(
+    "header, expected", [("0.5", 0.5), ("x", 10), ("-1", 10), ("3600", 10)]
+)
+def test_request_timeout_header(http_server, score_request, caplog, header, expected):
+    caplog.set_level(logging.INFO)
+    post(http_server, json.dumps(score_request), {"X-Request-Timeout": header})
+    contexts = [r.msg for r in caplog.records if isinstance(r.msg, dict)]
+    assert contexts[-1]["timeout"] == expected
+
+
+@pytest.fixture
+def response_cache(http_server, storage, mocker):
+    cache = ResponseCache(storage, ttl=5)
+    mocker.patch.object(http_server.RequestHandlerClass, "response_cache", cache)
+    return cache
+
+
+def test_response_cache(http_server, response_cache, storage):
+    req = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "clients_interests",
+        "arguments": {"client_ids": [1, 2, 3]},
+    }
+    set_valid_auth(req)
+    response, data = post(http_server, json.dumps(req))
+    assert "response_cache;dur=" in response.getheader("Server-Timing")
+    assert "handler;dur=" in response.getheader("Server-Timing")
+    # the same clients in another order are served from the cache
+    req["arguments"]["client_ids"] = [3, 1, 2, 1]
+    response, cached = post(http_server, json.dumps(req))
+    assert response.status == 200
+    assert "handler;dur=" not in response.getheader("Server-Timing")
+    assert cached == data
+    # a write makes the cached response stale
+    scoring.set_interests(storage, 2, ["travel"])
+    response, data = post(http_server, json.dumps(req))
+    assert "handler;dur=" in response.getheader("Server-Timing")
+    assert json.loads(data)["response"]["2"] == ["travel"]
+
+
+def test_response_cache_is_per_encoding(
+    http_server, response_cache, interests_request, mocker
+):
+    mocker.patch.dict("api.COMPRESSORS", {"gzip": api.COMPRESSORS["gzip"]}, clear=True)
+    _, plain = post(http_server, json.dumps(interests_request))
+    response, data = post(
+        http_server, json.dumps(interests_request), {"Accept-Encoding": "gzip"}
+    )
+    assert response.getheader("Content-Encoding") == "gzip"
+    assert gzip.decompress(data) == plain
+    response, cached = post(
+        http_server, json.dumps(interests_request), {"Accept-Encoding": "gzip"}
+    )
+    assert "handler;dur=" not in response.getheader("Server-Timing")
+    assert response.getheader("Content-Encoding") == "gzip"
+    assert cached == data
+
+
+def test_response_cache_skips_errors(http_server, response_cache, storage):
+    req = {
+        "account": "horns&hoofs",
+        "login": "h&f",
+        "method": "clients_interests",
+        "arguments": {"client_ids": []},
+    }
+    set_valid_auth(req)
+    for _ in range(2):
+        response, data = post(http_server, json.dumps(req))
+        assert json.loads(data)["code"] == api.INVALID_REQUEST
+        assert "handler;dur=" in response.getheader("Server-Timing")
@@ -0,0 +1,170 @@
+import io
+import json
+import logging
+
+import pytest
+
+import replay
+
+from .test_api import set_valid_auth
+from .test_http import post
+
+
+@pytest.fixture
+def api_log(http_server):
+    """Log of a few requests written in the api.py format"""
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(
+        logging.Formatter(
+            "[%(asctime)s] %(levelname).1s %(message)s", datefmt=replay.TIME_FORMAT
+        )
+    )
+    root = logging.getLogger()
+    root.addHandler(handler)
+    # setLevel, unlike assigning the level, drops the cached isEnabledFor results
+    level = root.level
+    root.setLevel(logging.INFO)
+    try:
+        for i, arguments in enumerate(
+            [{"client_ids": [1, 2]}, {"client_ids": [3]}, {"client_ids": "x"}]
+        ):
+            req = {
+                "account": "horns&hoofs",
+                "login": "h&f",
+                "method": "clients_interests",
+                "arguments": arguments,
+            }
+            set_valid_auth(req)
+            post(http_server, json.dumps(req), {"X-Request-Id": f"req-{i}"})
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(level)
+    return stream.getvalue().splitlines(keepends=True)
+
+
+def test_parse_plain_log(api_log):
+    events = replay.parse_log(api_log)
+    assert [e.request_id for e in events] == ["req-0", "req-1", "req-2"]
+    assert all(e.path == "/method" for e in events)
+    assert json.loads(events[0].body)["arguments"] == {"client_ids": [1, 2]}
+    assert events[2].expected["code"] == 422
+    assert set(events[0].expected["response"]) == {"1", "2"}
+
+
+@pytest.mark.parametrize(
+    "path, request_id",
+    [
+        ("/method", "req 0"),
+        ("/method", "a: b'c' d"),
+        ("/a b", "req-0"),
+        ("/a: b'x'", "req-0"),
+    ],
+)
+def test_parse_plain_log_keeps_ids_with_spaces(path, request_id):
+    body = b'{"method": "it\'s"}'
+    line = "[2024.01.02 03:04:05] I %s: %s %s\n" % (path, body, request_id)
+    skipped = {}
+    events = replay.parse_log([line], skipped)
+    assert [(e.path, e.body, e.request_id) for e in events] == [
+        (path, body, request_id)
+    ]
+    assert skipped == {}
+
+
+def test_parse_plain_log_counts_skipped_lines(api_log):
+    lines = list(api_log)
+    lines.insert(1, "[2024.01.02 03:04:05] I /method: b'{} req-x\n")
+    lines.insert(1, "[2024.01.02 03:04:05] I {'request_id': \n")
+    lines.insert(1, "[2024.01.02 03:04:05] I Starting server at 8080\n")
+    skipped = {}
+    events = replay.parse_log(lines, skipped)
+    assert [e.request_id for e in events] == ["req-0", "req-1", "req-2"]
+    assert skipped == {"request": 1, "context": 1}
+
+
+def test_parse_jsonl():
+    lines = [
+        json.dumps({"time": 2, "path": "/method", "body": {"a": 1}, "code": 200}),
+        "\n",
+        json.dumps({"time": 1, "path": "/method", "body": "{}", "request_id": "x"}),
+    ]
+    skipped = {}
+    events = replay.parse_log(lines + ["{not json\n", '{"time": 3}\n'], skipped)
+    assert skipped == {"record": 2}
+    assert [e.time for e in events] == [1, 2]
+    assert events[0].expected is None
+    assert events[1].body == b'{"a": 1}'
+    assert events[1].expected == {"code": 200}
+
+
+def test_replay_same_server_has_no_diffs(http_server, api_log):
+    events = replay.parse_log(api_log)
+    target = "http://%s:%s" % http_server.server_address
+    results = replay.replay(events, target, speed=0, concurrency=2)
+    summary = replay.summarize(results, 1.0)
+    assert summary["requests"] == 3
+    assert summary["failed"] == 0
+    assert summary["compared"] == 3
+    assert summary["codes"] == {200: 2, 422: 1}
+    assert summary["diffs"] == []
+    assert summary["latency_ms"]["max"] >= summary["latency_ms"]["p50"] > 0
+
+
+def test_replay_reports_diffs(http_server, api_log):
+    events = replay.parse_log(api_log)
+    events[0] = events[0]._replace(expected={"code": 200, "response": {}})
+    target = "http://%s:%s" % http_server.server_address
+    summary = replay.summarize(replay.replay(events, target, speed=0), 1.0)
+    assert len(summary["diffs"]) == 1
+    assert summary["diffs"][0].startswith("req-0")
+
+
+def test_replay_keeps_timing(mocker):
+    send = mocker.patch("replay.send")
+    sleep = mocker.patch("replay.time.sleep")
+    events = [replay.Event(t, "/method", b"{}", str(t)) for t in (10.0, 12.0, 14.0)]
+    replay.replay(events, "http://localhost:1", speed=2)
+    assert send.call_count == 3
+    delays = [call.args[0] for call in sleep.call_args_list]
+    assert len(delays) == 2
+    assert delays[0] == pytest.approx(1, abs=0.1)
+    assert delays[1] == pytest.approx(2, abs=0.1)
+
+
+@pytest.mark.parametrize(
+    "values, pct, expected", [([], 50, 0.0), ([3, 1, 2], 50, 2), ([1, 2, 3], 99, 3)]
+)
+def test_percentile(values, pct, expected):
+    assert replay.percentile(values, pct) == expected
+
+
+def test_score_key_hit_rates():
+    birthday = "01.01.2000"
+    requests = [
+        {"phone": 79175002040, "email": "a@b.c"},
+        {"phone": "79175002040", "email": "A@b.c"},
+        {"first_name": "A", "last_name": "b ", "gender": 0, "birthday": birthday},
+        {"first_name": "a", "last_name": "b", "gender": 0, "birthday": birthday},
+        {"first_name": "a", "last_name": "b", "gender": 1, "birthday": birthday},
+    ]
+    events = [
+        replay.Event(
+            t,
+            "/method",
+            json.dumps({"method": "online_score", "arguments": arguments}).encode(),
+            str(t),
+        )
+        for t, arguments in enumerate(requests)
+    ]
+    events.append(replay.Event(10, "/method", b'{"method": "x"}', "x"))
+    stats = replay.score_key_hit_rates(events)
+    assert stats["requests"] == 5
+    # legacy keys miss differently cased names and ignore gender
+    assert stats["legacy"] == {"hits": 2, "wrong_hits": 1, "hit_rate": 0.4, "keys": 3}
+    assert stats["normalized"] == {
+        "hits": 2,
+        "wrong_hits": 0,
+        "hit_rate": 0.4,
+        "keys": 3,
+    }
@@ -1,6 +1,11 @@
+import datetime
+import json
+import time
+
 import pytest
 import redis.exceptions
 
+import bloom
 import scoring
 
 
@@ -31,3 +36,231 @@ def test_get_interests_storage_connected(storage):
 def test_get_interests_storage_disconnected(disconnected_storage):
     with pytest.raises(redis.exceptions.ConnectionError):
         scoring.get_interests(disconnected_storage, "key")
+
+
+def test_get_score_caches_with_soft_and_hard_ttl(mocker, storage):
+    mocker.patch("scoring.get_key", return_value="swr")
+    mocker.patch("scoring.time.time", return_value=1000.0)
+    got = scoring.get_score(
+        storage, "74951111111", "test@test.com", soft_ttl=10, hard_ttl=60
+    )
+    assert got == 3.0
+    assert storage.client.get("swr") == b"3.0|1010.0"
+    assert 0 < storage.client.ttl("swr") <= 60
+
+
+def test_get_score_fresh_hit(mocker, storage):
+    mocker.patch("scoring.get_key", return_value="swr")
+    thread = mocker.patch("scoring.threading.Thread")
+    storage.cache_set(key="swr", value=f"7.0|{time.time() + 60}", seconds=60)
+    assert scoring.get_score(storage, "74951111111", "test@test.com") == 7.0
+    thread.assert_not_called()
+
+
+def test_get_score_stale_hit_refreshes_once(mocker, storage):
+    mocker.patch("scoring.get_key", return_value="swr")
+    thread = mocker.patch("scoring.threading.Thread")
+    storage.cache_set(key="swr", value=f"7.0|{time.time() - 1}", seconds=60)
+    assert scoring.get_score(storage, "74951111111", "test@test.com") == 7.0
+    assert scoring.get_score(storage, "74951111111", "test@test.com") == 7.0
+    thread.assert_called_once()
+    assert "swr" in scoring.refreshing
+    # run the refresh the way the background thread would
+    thread.call_args.kwargs["target"]()
+    assert "swr" not in scoring.refreshing
+    assert scoring.get_score(storage, "74951111111", "test@test.com") == 3.0
+    thread.assert_called_once()
+
+
+def test_get_interests_filtered_out(disconnected_storage):
+    disconnected_storage.interests_filter = bloom.BloomFilter(10)
+    try:
+        assert scoring.get_interests(disconnected_storage, "key") == []
+    finally:
+        disconnected_storage.interests_filter = None
+
+
+def test_set_interests_updates_filter(storage):
+    storage.interests_filter = bloom.BloomFilter(10)
+    try:
+        assert scoring.get_interests(storage, 100) == []
+        scoring.set_interests(storage, 100, ["travel"])
+        assert 100 in storage.interests_filter
+        assert storage.interests_filter.generation == bloom.get_generation(
+            storage.client
+        )
+        assert scoring.get_interests(storage, 100) == ["travel"]
+    finally:
+        storage.interests_filter = None
+
+
+@pytest.mark.parametrize(
+    "first, second",
+    [
+        ({"phone": 79175002040}, {"phone": "79175002040"}),
+        ({"phone": "79175002040"}, {"phone": " 79175002040 "}),
+        (
+            {"phone": None, "first_name": "Ivan", "last_name": "Petrov"},
+            {"phone": None, "first_name": " ivan ", "last_name": "PETROV"},
+        ),
+        (
+            {"phone": None, "first_name": "Anna  Maria", "last_name": "b"},
+            {"phone": None, "first_name": "anna maria", "last_name": "b"},
+        ),
+        (
+            {"phone": "79175002040", "email": "Test@Test.com"},
+            {"phone": "79175002040", "email": "test@test.com "},
+        ),
+    ],
+)
+def test_get_key_normalized(first, second):
+    assert scoring.get_key(**first) == scoring.get_key(**second)
+
+
+@pytest.mark.parametrize(
+    "first, second",
+    [
+        ({"phone": "79175002040"}, {"phone": "79175002040", "email": "a@b.c"}),
+        (
+            {"phone": None, "birthday": datetime.date(2000, 1, 1)},
+            {"phone": None, "birthday": datetime.date(2000, 1, 1), "gender": 1},
+        ),
+        (
+            {"phone": None, "first_name": "ab", "last_name": "c"},
+            {"phone": None, "first_name": "a", "last_name": "bc"},
+        ),
+    ],
+)
+def test_get_key_covers_score_fields(first, second):
+    assert scoring.get_key(**first) != scoring.get_key(**second)
+
+
+def test_get_key_formats(mocker):
+    binary = scoring.get_key("79175002040")
+    mocker.patch("scoring.SCORE_KEY_FORMAT", "hex")
+    readable = scoring.get_key("79175002040")
+    assert binary == scoring.KEY_PREFIX + bytes.fromhex(readable[5:])
+    assert len(binary) == 21 and len(readable) == 37
+
+
+def test_interests_as_of_date(storage):
+    today = datetime.date.today()
+    days = [today - datetime.timedelta(days=n) for n in (10, 5, 0)]
+    scoring.set_interests(storage, 200, ["books"], date=days[0])
+    scoring.set_interests(storage, 200, ["books", "music"], date=days[1])
+    scoring.set_interests(storage, 200, ["cinema"], date=days[2])
+    got = scoring.get_interests_as_of(
+        storage, [200, 201, 0], today - datetime.timedelta(days=7)
+    )
+    assert got[200] == ["books"]
+    # no history at all
+    assert got[201] == []
+    assert got[0] == json.loads(storage.client.get("i:0"))
+    dates = [today - datetime.timedelta(days=n) for n in (11, 5, 1, 0)]
+    assert [scoring.get_interests_as_of(storage, [200], d)[200] for d in dates] == [
+        [],
+        ["books", "music"],
+        ["books", "music"],
+        ["cinema"],
+    ]
+    assert scoring.get_interests(storage, 200) == ["cinema"]
+
+
+def test_set_interests_stores_changes_only(storage):
+    today = datetime.date.today()
+    for n in range(5, -1, -1):
+        scoring.set_interests(
+            storage, 210, ["travel"], date=today - datetime.timedelta(days=n)
+        )
+    # the interests before the first change, none here, and the change
+    assert storage.client.zcard("iv:210") == 2
+    scoring.set_interests(storage, 210, ["sport"])
+    assert storage.client.zcard("iv:210") == 3
+
+
+def test_set_interests_bumps_generation_on_change(storage):
+    generation = bloom.get_generation(storage.client)
+    scoring.set_interests(storage, 240, ["books"])
+    scoring.set_interests(storage, 240, ["books"])
+    assert bloom.get_generation(storage.client) == generation + 1
+
+
+def test_set_interests_in_the_past(storage):
+    today = datetime.date.today()
+    storage.client.set("i:230", '["books"]')
+    scoring.set_interests(storage, 230, ["music"], today - datetime.timedelta(days=3))
+    assert scoring.get_interests(storage, 230) == ["music"]
+    scoring.set_interests(storage, 230, ["sport"], today + datetime.timedelta(days=1))
+    scoring.set_interests(storage, 230, ["cinema"], today - datetime.timedelta(days=1))
+    # a later change is recorded, it stays the latest
+    assert scoring.get_interests(storage, 230) == ["sport"]
+    dates = [today - datetime.timedelta(days=n) for n in (5, 2, 0)]
+    assert [scoring.get_interests_as_of(storage, [230], d)[230] for d in dates] == [
+        ["books"],
+        ["music"],
+        ["sport"],
+    ]
+
+
+def test_set_interests_compacts_old_versions(storage, mocker):
+    mocker.patch("scoring.INTERESTS_RETENTION_DAYS", 30)
+    today = datetime.date.today()
+    for n, interests in ((100, ["a"]), (60, ["b"]), (40, ["c"]), (10, ["d"])):
+        date = today - datetime.timedelta(days=n)
+        scoring.set_interests(storage, 220, interests, date=date)
+    # the version in effect 30 days ago is kept, older ones are dropped
+    assert storage.client.zcard("iv:220") == 2
+    date = today - datetime.timedelta(days=30)
+    assert scoring.get_interests_as_of(storage, [220], date)[220] == ["c"]
+    assert 0 < storage.client.ttl("iv:220") <= 30 * 24 * 60 * 60
+
+
+@pytest.fixture
+def script_lookup(mocker):
+    # fakeredis runs lua scripts with lupa, the `lua` extra of fakeredis
+    pytest.importorskip("lupa")
+    mocker.patch("scoring.SCORE_LOOKUP", "script")
+
+
+@pytest.mark.parametrize(
+    "person",
+    [
+        {"phone": "74951111111", "email": "test@test.com"},
+        {"phone": None, "email": None, "first_name": "a", "last_name": "b"},
+        {
+            "phone": "74951111111",
+            "email": "test@test.com",
+            "birthday": datetime.date(2000, 1, 1),
+            "gender": 1,
+            "first_name": "a",
+            "last_name": "b",
+        },
+        {"phone": None, "email": None},
+    ],
+)
+def test_get_score_script_lookup(person, mocker, storage, script_lookup):
+    mocker.patch("scoring.time.time", return_value=1000.0)
+    key = scoring.get_key(**person)
+    storage.client.delete(key)
+    got = scoring.get_score(storage, soft_ttl=10, hard_ttl=60, **person)
+    assert got == scoring.compute_score(**person)
+    # cached like the client side lookup does it
+    cached = storage.client.get(key)
+    assert cached == scoring.encode_score(got, 10).encode()
+    assert 0 < storage.client.ttl(key) <= 60
+    storage.client.set(key, "4.5|2000.0")
+    assert scoring.get_score(storage, **person) == 4.5
+
+
+def test_get_score_script_reloaded_after_flush(mocker, storage, script_lookup):
+    mocker.patch("scoring.get_key", return_value="script-flush")
+    assert scoring.get_score(storage, "74951111111", None) == 1.5
+    storage.client.script_flush()
+    storage.client.delete("script-flush")
+    assert scoring.get_score(storage, None, "test@test.com") == 1.5
+    assert storage.client.get("script-flush")
+
+
+def test_get_score_script_storage_disconnected(mocker, disconnected_storage):
+    mocker.patch("scoring.SCORE_LOOKUP", "script")
+    assert scoring.get_score(disconnected_storage, "74951111111", None) == 1.5
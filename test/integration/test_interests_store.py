@@ -0,0 +1,77 @@
+import json
+
+import pytest
+
+import interests_store
+import scoring
+
+
+@pytest.fixture
+def snapshot_path(tmp_path):
+    path = str(tmp_path / "interests.db")
+    records = [(cid, json.dumps(["books", str(cid)]).encode()) for cid in (5, 1, 3)]
+    interests_store.build_snapshot(records, path)
+    return path
+
+
+@pytest.mark.parametrize(
+    "key, expected",
+    [
+        ("i:1", b'["books", "1"]'),
+        ("i:3", b'["books", "3"]'),
+        ("i:5", b'["books", "5"]'),
+        ("i:2", None),
+        ("i:x", None),
+        ("uid:1", None),
+    ],
+)
+def test_mmap_store_get(snapshot_path, key, expected):
+    store = interests_store.MmapInterestsStore(snapshot_path)
+    assert store.get(key) == expected
+
+
+def test_mmap_store_get_is_not_copied(snapshot_path):
+    store = interests_store.MmapInterestsStore(snapshot_path)
+    value = store.get("i:3")
+    assert isinstance(value, memoryview)
+    assert value.obj is store.snapshot.mm
+
+
+def test_mmap_store_get_interests(snapshot_path):
+    store = interests_store.MmapInterestsStore(snapshot_path)
+    assert scoring.get_interests(store, 5) == ["books", "5"]
+    assert scoring.get_interests(store, 4) == []
+
+
+def test_mmap_store_swap_snapshot(snapshot_path, mocker):
+    mocker.patch.object(interests_store.MmapInterestsStore, "CHECK_INTERVAL", 0)
+    store = interests_store.MmapInterestsStore(snapshot_path)
+    interests_store.build_snapshot([(2, b'["sport"]')], snapshot_path)
+    assert store.get("i:2") == b'["sport"]'
+    assert store.get("i:1") is None
+
+
+def test_build_snapshot_from_jsonl(tmp_path):
+    source = tmp_path / "interests.jsonl"
+    source.write_text(
+        '{"client_id": 7, "interests": ["cinema"]}\n\n'
+        '{"client_id": 7, "interests": ["music"]}\n'
+    )
+    path = str(tmp_path / "interests.db")
+    records = interests_store.read_jsonl(str(source))
+    assert interests_store.build_snapshot(records, path) == 1
+    assert interests_store.MmapInterestsStore(path).get("i:7") == b'["music"]'
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "interests.db",
+        "interests.jsonl",
+    ]
+
+
+def test_build_snapshot_from_redis(storage, tmp_path):
+    path = str(tmp_path / "interests.db")
+    total = interests_store.build_snapshot(
+        interests_store.read_redis(storage.client), path
+    )
+    store = interests_store.MmapInterestsStore(path)
+    assert total >= 4
+    assert store.get("i:0") == storage.get("i:0")
@@ -0,0 +1,101 @@
+import datetime
+import io
+import json
+
+import fakeredis
+import pytest
+
+import bloom
+import load_interests
+import scoring
+from storage import Storage
+
+
+@pytest.fixture
+def empty_storage():
+    s = Storage(socket_timeout=1, socket_connect_timeout=1)
+    s.client = fakeredis.FakeRedis(server=fakeredis.FakeServer())
+    yield s
+    s.client.close()
+
+
+def test_read_csv():
+    source = io.StringIO(
+        'client_id,interests\n1,"[""books"", ""music""]"\n2,cinema; sport\n3,\n'
+    )
+    assert list(load_interests.read_csv(source)) == [
+        (1, '["books", "music"]'),
+        (2, '["cinema", "sport"]'),
+        (3, "[]"),
+    ]
+
+
+def test_read_jsonl():
+    source = io.StringIO('{"client_id": 1, "interests": ["books"]}\n\n')
+    assert list(load_interests.read_jsonl(source)) == [(1, '["books"]')]
+
+
+@pytest.mark.parametrize("batch_size, workers", [(1, 1), (3, 2), (100, 4)])
+def test_load(empty_storage, batch_size, workers):
+    rows = [(cid, json.dumps([str(cid)])) for cid in range(10)]
+    total = load_interests.load(rows, empty_storage, batch_size, workers)
+    assert total == 10
+    for cid in range(10):
+        assert empty_storage.get(f"i:{cid}") == json.dumps([str(cid)]).encode()
+    # cached interests responses are invalidated once per load
+    assert empty_storage.get(scoring.INTERESTS_GENERATION_KEY) == b"1"
+
+
+def test_load_resumes_from_checkpoint(empty_storage, tmp_path, mocker):
+    checkpoint = str(tmp_path / "load.checkpoint")
+    rows = [(cid, "[]") for cid in range(10)]
+    set_versions = mocker.patch.object(
+        empty_storage,
+        "set_versions",
+        side_effect=[(3, None), (3, None), ConnectionError],
+    )
+    with pytest.raises(ConnectionError):
+        load_interests.load(
+            rows, empty_storage, 3, workers=1, checkpoint=checkpoint, checkpoint_every=1
+        )
+    assert load_interests.read_checkpoint(checkpoint) == 6
+
+    set_versions.reset_mock(side_effect=True)
+    set_versions.return_value = (3, None)
+    total = load_interests.load(rows, empty_storage, 3, checkpoint=checkpoint)
+    assert total == 10
+    resumed = [key for call in set_versions.call_args_list for key in call.args[0]]
+    assert resumed == ["iv:6", "iv:7", "iv:8", "iv:9"]
+
+
+def test_load_updates_filter(empty_storage, tmp_path):
+    path = str(tmp_path / "interests.bloom")
+    interests_filter = bloom.BloomFilter(100)
+    rows = [(cid, "[]") for cid in (5, 7)]
+    load_interests.load(
+        rows, empty_storage, interests_filter=interests_filter, filter_path=path
+    )
+    saved = bloom.BloomFilter.load(path)
+    assert 5 in saved and 7 in saved
+    assert saved.generation == bloom.get_generation(empty_storage.client)
+    # ids added by another writer meanwhile are kept
+    other = bloom.BloomFilter(100)
+    other.add(9)
+    other.save(path, merge=True)
+    saved = bloom.BloomFilter.load(path)
+    assert 5 in saved and 9 in saved
+
+
+def test_load_keeps_interests_history(empty_storage):
+    today = datetime.date.today()
+    week_ago = today - datetime.timedelta(days=7)
+    scoring.set_interests(empty_storage, 7, ["old"], today - datetime.timedelta(days=2))
+    load_interests.load([(7, '["new"]'), (8, '["first"]')], empty_storage)
+    assert scoring.get_interests_as_of(empty_storage, [7], today)[7] == ["new"]
+    assert scoring.get_interests(empty_storage, 7) == ["new"]
+    yesterday = today - datetime.timedelta(days=1)
+    assert scoring.get_interests_as_of(empty_storage, [7, 8], yesterday) == {
+        7: ["old"],
+        8: [],
+    }
+    assert scoring.get_interests_as_of(empty_storage, [7], week_ago)[7] == []
@@ -1,8 +1,15 @@
+import socket
 import time
 
 import pytest
 import redis
 
+import bloom
+import ratelimit
+import scoring
+import shmcache
+import storage as storage_module
+
 
 def test_storage_health_check(storage):
     assert storage.health_check()
@@ -54,3 +61,189 @@ def test_storage_cache_get(storage, storage_object):
 def test_disconnected_storage_cache_get(disconnected_storage, storage_object):
     result = disconnected_storage.cache_get("key")
     assert not result
+
+
+def test_storage_call_stats(storage):
+    storage.reset_stats()
+    storage.cache_get("key")
+    storage.cache_get("key")
+    storage.get("key")
+    stats = storage.get_stats()
+    assert stats["cache_get"]["count"] == 2
+    assert stats["get"]["count"] == 1
+    assert stats["get"]["ms"] >= 0
+
+
+def test_redis_rate_limiter(storage):
+    # fakeredis runs lua scripts with lupa, the `lua` extra of fakeredis
+    pytest.importorskip("lupa")
+    limiter = ratelimit.RedisRateLimiter(storage.client, rate=0.001, burst=2)
+    assert [limiter.allow("acc") for _ in range(3)] == [True, True, False]
+    assert limiter.allow("other")
+
+
+def test_disconnected_redis_rate_limiter(disconnected_storage):
+    limiter = ratelimit.RedisRateLimiter(disconnected_storage.client, 1, 1)
+    assert limiter.allow("acc")
+
+
+def test_build_interests_filter(storage):
+    bf = bloom.build_from_redis(storage.client)
+    assert all(cid in bf for cid in range(4))
+    assert bf.count >= 4
+
+
+def test_open_interests_filter_rebuilds_stale_file(storage, tmp_path):
+    path = str(tmp_path / "interests.bloom")
+    generation = bloom.get_generation(storage.client)
+    bf = bloom.open_filter(storage.client, path)
+    assert bf.generation == generation
+    assert all(cid in bf for cid in range(4))
+    # interests written without adding their ids to the file
+    bloom.BloomFilter(10).save(path)
+    storage.client.incr(scoring.INTERESTS_GENERATION_KEY)
+    bf = bloom.open_filter(storage.client, path)
+    assert bf.generation == generation + 1
+    assert all(cid in bf for cid in range(4))
+    # an up to date file is used as it is
+    fresh = bloom.BloomFilter(10)
+    fresh.generation = generation + 1
+    fresh.save(path)
+    assert 0 not in bloom.open_filter(storage.client, path)
+
+
+def test_storage_get_deadline_exceeded(storage):
+    with pytest.raises(storage_module.DeadlineExceeded):
+        storage.get("key", deadline=time.monotonic() - 1)
+
+
+def test_storage_cache_get_deadline_exceeded(storage):
+    storage.cache_set(key="key", value="value", seconds=10)
+    assert storage.cache_get("key", deadline=time.monotonic() - 1) is None
+    assert storage.cache_get("key", deadline=time.monotonic() + 10) == b"value"
+
+
+def test_disconnected_storage_get_deadline(disconnected_storage):
+    started = time.monotonic()
+    with pytest.raises(storage_module.DeadlineExceeded):
+        disconnected_storage.get("key", deadline=started + 0.5)
+    assert time.monotonic() - started < 1
+
+
+@pytest.fixture
+def stalled_redis():
+    """Address of a server which accepts connections and never answers"""
+    server = socket.socket()
+    server.bind(("localhost", 0))
+    server.listen()
+    yield server.getsockname()
+    server.close()
+
+
+def test_storage_call_bounded_by_deadline(stalled_redis):
+    host, port = stalled_redis
+    storage = storage_module.Storage(socket_timeout=10, socket_connect_timeout=10)
+    storage.client.connection_pool.connection_kwargs.update(host=host, port=port)
+    started = time.monotonic()
+    with pytest.raises(storage_module.DeadlineExceeded):
+        storage.get("key", deadline=started + 0.3)
+    assert storage.cache_get("key", deadline=time.monotonic() + 0.3) is None
+    assert time.monotonic() - started < 2
+    storage.client.close()
+
+
+def test_storage_local_cache(storage, mocker):
+    cache = shmcache.SharedCache(slots=64)
+    mocker.patch.object(storage, "local_cache", cache)
+    try:
+        storage.cache_set("key", 3.5, seconds=60)
+        assert cache.get("key") == b"3.5"
+        storage.client.delete("key")
+        # served from the shared cache without asking redis
+        assert storage.cache_get("key") == b"3.5"
+        storage.client.set("other", "1")
+        assert storage.cache_get("other") == b"1"
+        assert cache.get("other") == b"1"
+    finally:
+        cache.close()
+        cache.unlink()
+
+
+def test_storage_versions(storage):
+    assert storage.set_version("v:1", "a", 10, keep_since=0, seconds=60)
+    assert not storage.set_version("v:1", "a", 12, keep_since=0, seconds=60)
+    assert storage.set_version("v:1", "b", 15, keep_since=0, seconds=60)
+    storage.client.set("latest:2", "c")
+    got = storage.get_versions(
+        ["v:1", "v:1", "v:1", "v:2"], ["-", "-", "-", "latest:2"], 14
+    )
+    assert got[:3] == ["a", "a", "a"]
+    assert got[3] == b"c"
+    assert storage.get_versions(["v:1", "v:1"], ["-", "-"], 9) == [None, None]
+    assert storage.get_versions(["v:1"], ["-"], 15) == ["b"]
+
+
+def test_storage_versions_latest_key(storage):
+    storage.client.set("latest:3", "a")
+    assert storage.set_version("v:3", "b", 10, 0, 60, latest_key="latest:3")
+    assert storage.client.get("latest:3") == b"b"
+    assert storage.set_version("v:3", "c", 5, 0, 60, latest_key="latest:3")
+    assert storage.client.get("latest:3") == b"b"
+    got = storage.get_versions(["v:3"] * 3, ["latest:3"] * 3, 4)
+    assert got == ["a"] * 3
+    storage.set_version("v:4", "d", 10, 0, 60, latest_key="latest:4")
+    assert storage.get_versions(["v:4"], ["latest:4"], 9) == [""]
+
+
+def test_storage_versions_interleaved_write(storage, mocker):
+    read_versions = storage.read_versions
+    other = storage_module.Storage(socket_timeout=1, socket_connect_timeout=1)
+    other.client = storage.client
+
+    def read_then_interleave(*args):
+        reads = read_versions(*args)
+        if read_then_interleave.first:
+            # another writer records a later change meanwhile
+            read_then_interleave.first = False
+            other.set_version("v:5", "b", 20, 0, 60, latest_key="latest:5")
+        return reads
+
+    read_then_interleave.first = True
+    mocker.patch.object(storage, "read_versions", side_effect=read_then_interleave)
+    assert storage.set_version("v:5", "a", 10, 0, 60, latest_key="latest:5")
+    assert storage.client.get("latest:5") == b"b"
+    members = storage.client.zrange("v:5", 0, -1)
+    assert members == [b"0|", b"10|a", b"20|b"]
+
+
+def test_storage_set_versions(storage):
+    changed = storage.set_versions(
+        {"v:6": "a", "v:7": "b"}, 10, 0, 60, {"v:6": "latest:6", "v:7": "latest:7"}
+    )
+    assert changed == (2, None)
+    assert storage.set_versions({"v:6": "a"}, 11, 0, 60, incr_key="n:6") == (0, None)
+    assert storage.set_versions({"v:7": "c"}, 11, 0, 60, incr_key="n:6") == (1, 1)
+    assert storage.get_versions(["v:6", "v:7"], ["-", "-"], 11) == ["a", "c"]
+    assert storage.client.get("n:6") == b"1"
+    assert storage.client.mget("latest:6", "latest:7") == [b"a", b"b"]
+
+
+def test_storage_versions_index(storage, mocker):
+    storage.set_versions({"v:8": "a"}, 10, 0, 60, {"v:8": "latest:8"}, index_key="vx")
+    storage.set_versions({"v:8": "b"}, 20, 0, 60, {"v:8": "latest:8"}, index_key="vx")
+    storage.set_versions({"v:8": "c"}, 15, 0, 60, {"v:8": "latest:8"}, index_key="vx")
+    assert storage.client.hget("vx", "v:8") == b"20"
+    storage.client.set("latest:9", "d")
+    pipeline = mocker.spy(storage.client, "pipeline")
+    got = storage.get_versions(["v:8", "v:9"], ["latest:8", "latest:9"], 25, "vx")
+    assert got == [b"b", b"d"]
+    # both answered by the latest keys, no set is looked up
+    pipeline.assert_called_once()
+    got = storage.get_versions(["v:8", "v:8", "v:8"], ["latest:8"] * 3, 15, "vx")
+    assert got == ["c", "c", "c"]
+    assert storage.get_versions(["v:8"], ["latest:8"], 9, "vx") == [""]
+
+
+def test_disconnected_storage_versions(disconnected_storage):
+    with pytest.raises(redis.exceptions.ConnectionError):
+        disconnected_storage.get_versions(["v:1"], ["i:1"], 1)
@@ -0,0 +1,26 @@
+import pytest
+
+import bench
+
+
+@pytest.mark.parametrize(
+    "relative, expected",
+    [
+        (1.0, []),
+        (1.2, []),
+        (1.3, ["get_key"]),
+    ],
+)
+def test_compare(relative, expected):
+    baseline = {"get_key": {"us": 1.0, "relative": 1.0}}
+    results = {
+        "get_key": {"us": 2.0, "relative": relative},
+        "new_benchmark": {"us": 1.0, "relative": 1.0},
+    }
+    regressions = bench.compare(results, baseline, threshold=0.25)
+    assert [name for name, _ in regressions] == expected
+
+
+def test_benchmarks_run():
+    for func in bench.get_benchmarks().values():
+        func()
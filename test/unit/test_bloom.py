@@ -0,0 +1,143 @@
+import pytest
+import redis
+
+import bloom
+
+
+def test_bloom_filter_has_no_false_negatives():
+    bf = bloom.BloomFilter(1000, error_rate=0.01)
+    for cid in range(1000):
+        bf.add(cid)
+    assert all(cid in bf for cid in range(1000))
+
+
+def test_bloom_filter_false_positive_rate():
+    bf = bloom.BloomFilter(1000, error_rate=0.01)
+    for cid in range(1000):
+        bf.add(cid)
+    false_positives = sum(cid in bf for cid in range(1000, 11000))
+    assert false_positives / 10000 < 0.03
+    assert bf.false_positive_rate == pytest.approx(0.01, rel=0.2)
+
+
+def test_bloom_filter_save_load(tmp_path):
+    path = str(tmp_path / "interests.bloom")
+    bf = bloom.BloomFilter(10)
+    bf.add(42)
+    bf.save(path)
+    loaded = bloom.BloomFilter.load(path)
+    assert 42 in loaded
+    assert (loaded.size, loaded.hashes, loaded.count) == (bf.size, bf.hashes, 1)
+
+
+def test_bloom_filter_load_invalid(tmp_path):
+    path = tmp_path / "interests.bloom"
+    path.write_bytes(b"\0" * 64)
+    with pytest.raises(ValueError):
+        bloom.BloomFilter.load(str(path))
+
+
+def test_bloom_filter_load_without_generation(tmp_path):
+    path = tmp_path / "interests.bloom"
+    bf = bloom.BloomFilter(10)
+    bf.add(42)
+    header = bloom.HEADER_V1.pack(bloom.MAGIC_V1, bf.size, bf.hashes, bf.count)
+    path.write_bytes(header + bf.bits)
+    loaded = bloom.BloomFilter.load(str(path))
+    assert 42 in loaded
+    assert loaded.generation == 0
+
+
+def test_bloom_filter_save_merge(tmp_path):
+    path = str(tmp_path / "interests.bloom")
+    first, second = bloom.BloomFilter(10), bloom.BloomFilter(10)
+    first.add(1, generation=3)
+    first.save(path)
+    second.add(2, generation=2)
+    second.save(path, merge=True)
+    saved = bloom.BloomFilter.load(path)
+    assert 1 in saved and 2 in saved
+    assert saved.generation == 3
+    with pytest.raises(ValueError):
+        bloom.BloomFilter(1000).save(path, merge=True)
+
+
+def test_bloom_filter_merge_estimates_count():
+    first, second = bloom.BloomFilter(1000), bloom.BloomFilter(1000)
+    for cid in range(300):
+        first.add(cid)
+    for cid in range(200, 500):
+        second.add(cid)
+    first.merge(second)
+    assert first.count == pytest.approx(500, rel=0.05)
+
+
+def test_bloom_filter_file_reload(tmp_path, mocker):
+    mocker.patch.object(bloom.BloomFilterFile, "CHECK_INTERVAL", 0)
+    path = str(tmp_path / "interests.bloom")
+    bloom.BloomFilter(10).save(path)
+    bf = bloom.BloomFilterFile(path)
+    assert 7 not in bf
+    # another process adds a client and saves the filter
+    writer = bloom.BloomFilterFile(path)
+    mocker.patch("bloom.os.stat").return_value.st_mtime_ns = -1
+    writer.add(7, generation=5)
+    writer.save_added()
+    assert 7 in bf
+    assert bf.generation == 5
+
+
+def test_bloom_filter_file_saves_adds_later(tmp_path, mocker):
+    path = str(tmp_path / "interests.bloom")
+    bloom.BloomFilter(10).save(path)
+    bf = bloom.BloomFilterFile(path)
+    timer = mocker.patch("bloom.threading.Timer")
+    save = mocker.spy(bloom.BloomFilter, "save")
+    for cid in range(3):
+        bf.add(cid)
+    assert all(cid in bf for cid in range(3))
+    # one save for all the ids added meanwhile
+    timer.assert_called_once_with(bf.SAVE_DELAY, bf.save_added)
+    save.assert_not_called()
+    bf.save_added()
+    save.assert_called_once()
+    assert not bf.unsaved
+    bf.add(3)
+    assert timer.call_count == 2
+
+
+def test_bloom_filter_file_keeps_unsaved_adds(tmp_path, mocker):
+    mocker.patch.object(bloom.BloomFilterFile, "CHECK_INTERVAL", 0)
+    mocker.patch("bloom.threading.Timer")
+    path = str(tmp_path / "interests.bloom")
+    bloom.BloomFilter(10).save(path)
+    bf = bloom.BloomFilterFile(path)
+    mocker.patch.object(bloom.BloomFilter, "save", side_effect=OSError("full"))
+    bf.add(7, generation=2)
+    bf.save_added()
+    assert bf.unsaved == {7: 2}
+    # a filter saved by another process doesn't drop the id added here
+    mocker.patch("bloom.os.stat").return_value.st_mtime_ns = -1
+    assert 7 in bf
+    assert bf.generation == 2
+    mocker.stopall()
+    bf.save()
+    assert not bf.unsaved
+    assert 7 in bloom.BloomFilter.load(path)
+
+
+def test_bloom_filter_file_behind_generation(tmp_path, mocker):
+    mocker.patch.object(bloom.BloomFilterFile, "CHECK_INTERVAL", 0)
+    mocker.patch("bloom.threading.Timer")
+    path = str(tmp_path / "interests.bloom")
+    bloom.BloomFilter(10).save(path)
+    generation = mocker.Mock(return_value=0)
+    bf = bloom.BloomFilterFile(path, generation)
+    assert 7 not in bf
+    # interests written by someone not adding to the file
+    generation.return_value = 3
+    assert 7 in bf
+    bf.add(8, generation=3)
+    assert 7 not in bf
+    generation.side_effect = redis.exceptions.ConnectionError
+    assert 7 not in bf
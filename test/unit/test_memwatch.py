@@ -0,0 +1,43 @@
+import signal
+import tracemalloc
+
+import pytest
+
+import memwatch
+
+
+@pytest.fixture
+def watcher():
+    watcher = memwatch.MemoryWatcher(top=5)
+    yield watcher
+    watcher.stop()
+
+
+def test_report_without_tracing(watcher):
+    report = watcher.report()
+    assert report["rss"] > 0
+    assert report["gc"]["objects"] > 0
+    assert "top" not in report
+
+
+def test_report_growth(watcher):
+    watcher.start()
+    first = watcher.report()
+    assert len(first["top"]) <= 5
+    assert "rss_diff" not in first
+    leak = [bytearray(1024) for _ in range(1000)]
+    second = watcher.report()
+    assert "rss_diff" in second
+    assert max(stat["size_diff"] for stat in second["top"]) >= 1024 * 1000
+    assert any("test_memwatch.py" in stat["site"] for stat in second["top"])
+    del leak
+
+
+def test_signal_handler(watcher, caplog, mocker):
+    caplog.set_level("INFO")
+    handler = mocker.patch("memwatch.signal.signal")
+    watcher.install_signal_handler()
+    signum, callback = handler.call_args[0]
+    assert signum == signal.SIGUSR1
+    callback(signum, None)
+    assert any("Memory: rss" in r.getMessage() for r in caplog.records)
@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+import ratelimit
+
+
+def test_token_bucket_burst():
+    bucket = ratelimit.TokenBucket(rate=1, burst=3)
+    assert [bucket.consume() for _ in range(4)] == [True, True, True, False]
+
+
+def test_token_bucket_refill(mocker):
+    now = mocker.patch("ratelimit.time.monotonic", return_value=100.0)
+    bucket = ratelimit.TokenBucket(rate=2, burst=2)
+    assert bucket.consume() and bucket.consume()
+    assert not bucket.consume()
+    now.return_value = 100.5
+    assert bucket.consume()
+    assert not bucket.consume()
+
+
+def test_local_rate_limiter_is_per_key():
+    limiter = ratelimit.LocalRateLimiter(rate=0.001, burst=1)
+    assert limiter.allow("a")
+    assert not limiter.allow("a")
+    assert limiter.allow("b")
+
+
+def test_local_rate_limiter_evicts_old_keys(mocker):
+    mocker.patch.object(ratelimit.LocalRateLimiter, "MAX_KEYS", 2)
+    now = mocker.patch("ratelimit.time.monotonic", return_value=100.0)
+    limiter = ratelimit.LocalRateLimiter(rate=1, burst=1)
+    for key in ("a", "b", "c"):
+        limiter.allow(key)
+    # nothing has refilled yet
+    assert list(limiter.buckets) == ["a", "b", "c"]
+    now.return_value = 101.0
+    limiter.allow("d")
+    assert list(limiter.buckets) == ["c", "d"]
+
+
+def test_local_rate_limiter_keeps_throttled_keys(mocker):
+    mocker.patch.object(ratelimit.LocalRateLimiter, "MAX_KEYS", 2)
+    now = mocker.patch("ratelimit.time.monotonic", return_value=100.0)
+    limiter = ratelimit.LocalRateLimiter(rate=0.1, burst=1)
+    assert limiter.allow("abuser")
+    assert not limiter.allow("abuser")
+    # many other keys come while the abuser waits for a token
+    for n in range(20):
+        now.return_value += 0.1
+        limiter.allow(f"key{n}")
+    assert not limiter.allow("abuser")
+    # once refilled, they are forgotten down to MAX_KEYS
+    now.return_value += 20
+    limiter.allow("late")
+    assert list(limiter.buckets) == ["abuser", "late"]
+
+
+@pytest.mark.parametrize("max_inflight, expected", [(0, 3), (2, 2)])
+def test_load_shedder(max_inflight, expected):
+    shedder = ratelimit.LoadShedder(max_inflight)
+    assert sum(shedder.acquire() for _ in range(3)) == expected
+    shedder.release()
+    assert shedder.acquire()
+
+
+def test_lane_queues_and_rejects():
+    lane = ratelimit.Lane("heavy", workers=1, queue_size=1)
+    assert lane.acquire() == 0
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(lane.acquire(5)))
+    waiter.start()
+    while lane.stats()["waiting"] == 0:
+        time.sleep(0.001)
+    # the queue is full
+    assert lane.acquire() is None
+    lane.release()
+    waiter.join()
+    assert waited[0] is not None
+    lane.release()
+    stats = lane.stats()
+    assert stats["completed"] == 2
+    assert stats["rejected"] == 1
+    assert (stats["running"], stats["waiting"]) == (0, 0)
+    assert stats["wait_ms"]["max"] > 0
+
+
+def test_lane_wait_times_out():
+    lane = ratelimit.Lane("heavy", workers=1, queue_size=1)
+    lane.acquire()
+    assert lane.acquire(timeout=0.01) is None
+    assert lane.acquire(timeout=0) is None
+    assert lane.stats()["timed_out"] == 2
+
+
+@pytest.mark.parametrize(
+    "spec, expected",
+    [("online_score=8", ("online_score", 8, 0)), ("heavy=2:4", ("heavy", 2, 4))],
+)
+def test_parse_lane(spec, expected):
+    lane = ratelimit.Lane.parse(spec)
+    assert (lane.name, lane.workers, lane.queue_size) == expected
+
+
+@pytest.mark.parametrize("spec", ["heavy", "heavy=x", "=2", "heavy=0", "heavy=1:-1"])
+def test_parse_invalid_lane(spec):
+    with pytest.raises(ValueError):
+        ratelimit.Lane.parse(spec)
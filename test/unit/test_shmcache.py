@@ -0,0 +1,77 @@
+import os
+import time
+
+import pytest
+
+import shmcache
+
+
+@pytest.fixture
+def cache():
+    cache = shmcache.SharedCache(slots=64, value_size=16, stripes=4)
+    yield cache
+    cache.close()
+    cache.unlink()
+
+
+def test_shared_cache_get_set(cache):
+    assert cache.get("key") is None
+    assert cache.set("key", b"value", ttl=60)
+    assert cache.get("key") == b"value"
+    assert cache.get(b"key") == b"value"
+    cache.set("key", b"other", ttl=60)
+    assert cache.get("key") == b"other"
+
+
+def test_shared_cache_expires(cache, mocker):
+    cache.set("key", b"value", ttl=10)
+    mocker.patch("shmcache.time.time", return_value=time.time() + 11)
+    assert cache.get("key") is None
+
+
+def test_shared_cache_value_too_large(cache):
+    assert not cache.set("key", b"x" * 17, ttl=60)
+    assert cache.get("key") is None
+
+
+def test_shared_cache_evicts_within_probes(cache):
+    for i in range(1000):
+        cache.set(f"key{i}", str(i).encode(), ttl=60)
+    # a full table keeps working, recent keys win over old ones
+    assert cache.get("key999") == b"999"
+    assert sum(cache.get(f"key{i}") is not None for i in range(1000)) <= 64
+
+
+def test_shared_cache_overwrites_key_in_any_probe(cache):
+    positions = cache.positions(cache.digest("key"))
+
+    def fill(offsets, expires):
+        for offset in offsets:
+            entry = (b"x" * 16, expires, 0)
+            shmcache.ENTRY.pack_into(cache.shm.buf, offset + shmcache.SEQ.size, *entry)
+
+    # the slots before the last probe are taken by other keys
+    fill(positions[:-1], time.time() + 60)
+    cache.set("key", b"old", ttl=60)
+    # and expire, the key is still found in the last probe
+    fill(positions[:-1], 0)
+    cache.set("key", b"new", ttl=60)
+    assert cache.get("key") == b"new"
+    slots = [cache.read_slot(offset) for offset in positions]
+    assert [slot[2] for slot in slots if slot[0] == cache.digest("key")] == [b"new"]
+
+
+def test_shared_cache_busy_slot_misses(cache):
+    cache.set("key", b"value", ttl=60)
+    for offset in cache.positions(cache.digest("key")):
+        shmcache.SEQ.pack_into(cache.shm.buf, offset, 1)
+    assert cache.get("key") is None
+
+
+def test_shared_cache_between_processes(cache):
+    pid = os.fork()
+    if pid == 0:
+        cache.set("key", b"from child", ttl=60)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert cache.get("key") == b"from child"